@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# vim: fileencoding=utf-8
+#
+# Copyright (C) 2024
+#                   David Hobach <tripleh@hackingthe.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+''' Stand-in qubesd socket to test QubesDomains without Qubes OS.
+
+    It answers admin.vm.List and admin.vm.property.GetAll for a synthetic set of --vms domains and sends events to
+    admin.Events connections. The events are either replayed from a recording (--events) or generated: a random domain
+    is started or shut down every --interval seconds. The number of calls per admin API method is printed on exit.
+
+    A recording has one JSON object per line, e.g.:
+    {"delay": 0.5, "subject": "work", "event": "property-set:label", "kwargs": {"name": "label", "newvalue": "red"}}
+    The delay is the time in seconds to wait before sending the event.
+
+    Usage: python3 bench/fake_qubesd.py [--socket /tmp/qubesd.sock] [--vms 30] [--interval 1] [--events FILE]
+
+    Use `QubesDomains(socket='/tmp/qubesd.sock')` in the qtile configuration to connect to it.
+'''
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+
+LABELS = ['red', 'orange', 'yellow', 'green', 'gray', 'blue', 'purple', 'black']
+
+class FakeQubesd:
+
+    def __init__(self, vms, interval, events):
+        self.interval = interval
+        self.events = events
+        self.calls = collections.Counter()
+        self.domains = {'dom0': {'state': 'Running', 'label': 'black', 'memory': '4096'}}
+        for i in range(vms):
+            self.domains[f'vm{i:02d}'] = {'state': 'Running' if i % 3 == 0 else 'Halted', 'label': LABELS[i % len(LABELS)],
+                                          'memory': str(400 * (i % 4 + 1))}
+
+    @staticmethod
+    def encode_event(subject, event, kwargs):
+        data = b'1\0' + (subject or '').encode() + b'\0' + event.encode() + b'\0'
+        for key, value in kwargs.items():
+            data += key.encode() + b'\0' + str(value).encode() + b'\0'
+        return data + b'\0'
+
+    def apply(self, subject, event, kwargs):
+        ''' Keep the answers to admin.vm.List & admin.vm.property.GetAll consistent with the sent events. '''
+        domain = self.domains.get(subject)
+        if event == 'domain-add':
+            self.domains.setdefault(kwargs['vm'], {'state': 'Halted', 'label': 'red', 'memory': '400'})
+        elif event == 'domain-delete':
+            self.domains.pop(kwargs['vm'], None)
+        elif event == 'domain-start' and domain:
+            domain['state'] = 'Running'
+        elif event == 'domain-shutdown' and domain:
+            domain['state'] = 'Halted'
+        elif event.startswith('property-set:') and domain:
+            domain[kwargs.get('name')] = kwargs.get('newvalue')
+
+    def generate_events(self):
+        while True:
+            name = random.choice([name for name in self.domains if name != 'dom0'])
+            event = 'domain-shutdown' if self.domains[name]['state'] == 'Running' else 'domain-start'
+            yield self.interval, name, event, {}
+
+    def replay_events(self):
+        with open(self.events) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    yield entry.get('delay', 0), entry.get('subject'), entry['event'], entry.get('kwargs', {})
+
+    async def send_events(self, writer):
+        writer.write(self.encode_event(None, 'connection-established', {}))
+        await writer.drain()
+        for delay, subject, event, kwargs in (self.replay_events() if self.events else self.generate_events()):
+            await asyncio.sleep(delay)
+            self.apply(subject, event, kwargs)
+            writer.write(self.encode_event(subject, event, kwargs))
+            await writer.drain()
+        #like qubesd, keep the connection open
+        await asyncio.Future()
+
+    def call(self, method, dest):
+        if method == 'admin.vm.List':
+            return ''.join(f'{name} class={"AdminVM" if name == "dom0" else "AppVM"} state={d["state"]}\n' for name, d in self.domains.items())
+        if method == 'admin.vm.property.GetAll' and dest in self.domains:
+            d = self.domains[dest]
+            return f'label default=False type=label {d["label"]}\nmemory default=True type=int {d["memory"]}\nname default=False type=str {dest}\n'
+        raise ValueError(f'Unsupported call: {method} {dest}')
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.read()
+            _, method, dest, _ = request.split(b'\0', 4)[:4]
+            method, dest = method.decode(), dest.decode()
+            self.calls[method] += 1
+            if method == 'admin.Events':
+                await self.send_events(writer)
+            else:
+                try:
+                    writer.write(b'0\0' + self.call(method, dest).encode())
+                except ValueError as e:
+                    writer.write(b'2\0QubesException\0\0' + str(e).encode() + b'\0')
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def run(args):
+    qubesd = FakeQubesd(args.vms, args.interval, args.events)
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = await asyncio.start_unix_server(qubesd.handle, path=args.socket)
+    print(f'Serving {len(qubesd.domains)} domains at {args.socket}.')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        print('Calls:', dict(qubesd.calls))
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in qubesd socket.')
+    parser.add_argument('--socket', default='/tmp/qubesd.sock', help='Socket path (default: %(default)s).')
+    parser.add_argument('--vms', type=int, default=30, help='Number of synthetic domains (default: %(default)s).')
+    parser.add_argument('--interval', type=float, default=1, help='Seconds between two generated events (default: %(default)s).')
+    parser.add_argument('--events', help='File with recorded events to replay instead of generating events.')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
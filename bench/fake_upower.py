@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# vim: fileencoding=utf-8
+#
+# Copyright (C) 2024
+#                   David Hobach <tripleh@hackingthe.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+''' Stand-in UPower service on the D-Bus session bus to test QubesBattery without a battery or UPower.
+
+    It provides the UPower display device, which discharges by --step percent every --interval seconds until it is
+    empty and then charges until it is full. Each change is announced with a PropertiesChanged signal. The number of
+    signals sent is printed on exit.
+
+    Usage: qtile-env/bin/python bench/fake_upower.py [--interval 1] [--step 1] [--power 7.5]
+
+    Use `QubesBattery(upower_bus='session')` in the qtile configuration to connect to it.
+'''
+
+import argparse
+import asyncio
+
+from dbus_fast import BusType
+from dbus_fast.aio import MessageBus
+from dbus_fast.service import PropertyAccess, ServiceInterface, dbus_property
+
+UPOWER_SERVICE = 'org.freedesktop.UPower'
+UPOWER_DEVICE_INTERFACE = 'org.freedesktop.UPower.Device'
+UPOWER_DISPLAY_DEVICE = '/org/freedesktop/UPower/devices/DisplayDevice'
+
+STATE_CHARGING = 1
+STATE_DISCHARGING = 2
+STATE_FULLY_CHARGED = 4
+
+class FakeDevice(ServiceInterface):
+    ''' Subset of the org.freedesktop.UPower.Device interface used by QubesBattery. '''
+
+    def __init__(self, power):
+        super().__init__(UPOWER_DEVICE_INTERFACE)
+        self.percentage = 100.0
+        self.state = STATE_FULLY_CHARGED
+        self.power = power
+        self.signals = 0
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Percentage(self) -> 'd':
+        return self.percentage
+
+    @dbus_property(access=PropertyAccess.READ)
+    def State(self) -> 'u':
+        return self.state
+
+    @dbus_property(access=PropertyAccess.READ)
+    def EnergyRate(self) -> 'd':
+        return self.power if self.state in (STATE_CHARGING, STATE_DISCHARGING) else 0.0
+
+    @dbus_property(access=PropertyAccess.READ)
+    def TimeToEmpty(self) -> 'x':
+        return int(self.percentage * 60) if self.state == STATE_DISCHARGING else 0
+
+    @dbus_property(access=PropertyAccess.READ)
+    def TimeToFull(self) -> 'x':
+        return int((100 - self.percentage) * 60) if self.state == STATE_CHARGING else 0
+
+    def step(self, step):
+        ''' Advance the simulation by a single step and announce the changed properties. '''
+        if self.state == STATE_CHARGING:
+            self.percentage = min(self.percentage + step, 100.0)
+            if self.percentage >= 100:
+                self.state = STATE_FULLY_CHARGED
+        else:
+            self.state = STATE_DISCHARGING
+            self.percentage = max(self.percentage - step, 0.0)
+            if self.percentage <= 0:
+                self.state = STATE_CHARGING
+
+        self.emit_properties_changed({
+            'Percentage': self.percentage,
+            'State': self.state,
+            'EnergyRate': self.EnergyRate,
+            'TimeToEmpty': self.TimeToEmpty,
+            'TimeToFull': self.TimeToFull,
+        })
+        self.signals += 1
+
+async def run(args):
+    bus = await MessageBus(bus_type=BusType.SESSION).connect()
+    device = FakeDevice(args.power)
+    bus.export(UPOWER_DISPLAY_DEVICE, device)
+    await bus.request_name(UPOWER_SERVICE)
+    print(f'Serving {UPOWER_SERVICE} on the session bus at {bus.unique_name}.')
+    try:
+        while True:
+            await asyncio.sleep(args.interval)
+            device.step(args.step)
+    finally:
+        print(f'{device.signals} PropertiesChanged signals sent.')
+        bus.disconnect()
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in UPower service on the D-Bus session bus.')
+    parser.add_argument('--interval', type=float, default=1, help='Seconds between two changes (default: %(default)s).')
+    parser.add_argument('--step', type=float, default=1, help='Change of the battery percentage per step (default: %(default)s).')
+    parser.add_argument('--power', type=float, default=7.5, help='Power draw in W while (dis)charging (default: %(default)s).')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# vim: fileencoding=utf-8
+#
+# Copyright (C) 2024
+#                   David Hobach <tripleh@hackingthe.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+''' Offline benchmark of qubes.py & the config.py hooks against synthetic sessions without an X server.
+
+    The qtile X11 window code runs against a fake X connection, which serves the Qubes xprops of the synthetic windows
+    and counts the X server round-trips. Pipelined requests (several requests sent before the first reply is read) only
+    cost a single round-trip. Each round-trip adds the configured latency to the measured time.
+
+    Usage: qtile-env/bin/python bench/qubes_bench.py [--windows 10,100,1000] [--latency 100] [--repeat 10] [--sleep]
+
+    It must be run with a python that has qtile installed, e.g. the one of the venv created by the installer.
+'''
+
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+import libqtile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VM_NAMES = ['work', 'personal', 'untrusted', 'vault', 'sys-net', 'sys-firewall', 'chat:signal', 'dev']
+
+class FakeValue:
+    ''' Value of a fake GetPropertyReply: bytes or a list of atoms/window IDs. '''
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, ind):
+        #like xcffib, bytes values are lists of 1 byte items
+        if isinstance(self.data, bytes):
+            return self.data[ind:ind + 1]
+        return self.data[ind]
+
+    def to_string(self):
+        return bytes(self.data).decode()
+
+    def to_atoms(self):
+        return list(self.data)
+
+class FakeReply:
+
+    def __init__(self, data):
+        self.value_len = len(data)
+        self.value = FakeValue(data)
+
+class FakeCookie:
+
+    def __init__(self, conn, sequence, reply):
+        self.conn = conn
+        self.sequence = sequence
+        self._reply = reply
+
+    def reply(self):
+        self.conn.sync(self.sequence)
+        return self._reply
+
+class FakeProtocol:
+    ''' The xcffib core protocol subset used by qtile & qubes.py to read window properties. '''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def GetProperty(self, delete, wid, atom, type, offset, length):
+        data = self.conn.properties.get(wid, {}).get(self.conn.atoms.get_name(atom), [])
+        self.conn.sequence += 1
+        return FakeCookie(self.conn, self.conn.sequence, FakeReply(data))
+
+class FakeAtoms:
+
+    def __init__(self):
+        self.atoms = {}
+        self.reverse = {}
+
+    def __getitem__(self, name):
+        try:
+            return self.atoms[name]
+        except KeyError:
+            atom = len(self.atoms) + 1
+            self.atoms[name] = atom
+            self.reverse[atom] = name
+            return atom
+
+    def get_name(self, atom):
+        return self.reverse[atom]
+
+class FakeRoot:
+    ''' Root window. '''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def query_tree(self):
+        self.conn.sequence += 1
+        self.conn.sync(self.conn.sequence)
+        return list(self.conn.properties)
+
+class FakeConnection:
+    ''' Fake of the qtile X11 connection (libqtile.backend.x11.xcbq.Connection) with a configurable latency.
+        Window properties are stored as window ID --> {property name: bytes or list of atoms}.
+    '''
+
+    def __init__(self, latency, sleep):
+        self.latency = latency
+        self.sleep = sleep
+        self.atoms = FakeAtoms()
+        self.conn = self
+        self.core = FakeProtocol(self)
+        self.default_screen = FakeScreen(None)
+        self.default_screen.root = FakeRoot(self)
+        self.properties = {}
+        self.sequence = 0 #number of the last request
+        self.synced = 0 #number of the last request with a reply
+        self.roundtrips = 0
+        self.waited = 0 #simulated time spent waiting for the X server
+
+    def sync(self, sequence):
+        ''' Wait for the reply to a request. All requests sent before are answered with the same round-trip. '''
+        if sequence <= self.synced:
+            return
+        self.synced = self.sequence
+        self.roundtrips += 1
+        self.waited += self.latency
+        if self.sleep:
+            time.sleep(self.latency)
+
+class FakeCore:
+    name = 'x11'
+
+    def __init__(self, conn):
+        self.conn = conn
+
+class FakeFuture:
+
+    def cancel(self):
+        pass
+
+class FakeQtile:
+
+    def __init__(self, conn):
+        self.core = FakeCore(conn)
+        self.windows_map = {}
+        self.current_window = None
+
+    def _discard(self, *args):
+        for arg in args:
+            if hasattr(arg, 'close'): #coroutine
+                arg.close()
+        return FakeFuture()
+
+    def call_soon(self, func, *args):
+        return self._discard(*args)
+
+    def call_later(self, delay, func, *args):
+        return self._discard(*args)
+
+class FakeGroup:
+
+    def __init__(self, name):
+        self.name = name
+        self.windows = []
+        self.current_window = None
+
+class FakeClient:
+    ''' Synthetic client window. The X11 calls are made by the real qtile XWindow class. '''
+
+    def __init__(self, qtile, wid, name, group):
+        from libqtile.backend.x11.window import XWindow
+        self.qtile = qtile
+        self.wid = wid
+        self.window = XWindow(qtile.core.conn, wid)
+        self.name = name
+        self.group = group
+        self.minimized = False
+        self.maximized = False
+        self.floating = False
+        self.urgent = False
+        self.can_steal_focus = True
+        self.icons = {}
+
+    @property
+    def has_focus(self):
+        return self is self.qtile.current_window
+
+    def get_wm_class(self):
+        return [self.name, self.name]
+
+    def has_fixed_size(self):
+        return False
+
+    def has_fixed_ratio(self):
+        return False
+
+    def get_wm_type(self):
+        return self.window.get_wm_type()
+
+    def is_transient_for(self):
+        return self.qtile.windows_map.get(self.window.get_wm_transient_for())
+
+class FakeWindow:
+    ''' Internal bar window. '''
+
+    def __init__(self, qtile):
+        self.qtile = qtile
+
+    def create_drawer(self, width, height):
+        from libqtile.backend.base.drawer import Drawer
+        return Drawer(self.qtile, self, width, height)
+
+class FakeScreen:
+
+    def __init__(self, group):
+        self.group = group
+        self.left = self.right = None
+
+class FakeBar:
+
+    def __init__(self, qtile, screen, width=1920, size=24):
+        self.qtile = qtile
+        self.screen = screen
+        self.window = FakeWindow(qtile)
+        self.width = width
+        self.height = self.size = size
+        self.horizontal = True
+        self.background = '#000000'
+        self.widgets = []
+
+    def draw(self):
+        pass
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def create_session(qtile, conn, count):
+    ''' Create a synthetic session of count windows in a single group.
+        Every 10th window is a dom0 window without Qubes xprops, every 20th a transient window.
+    '''
+    group = FakeGroup('1')
+    conn.properties.clear()
+    qtile.windows_map.clear()
+    for i in range(count):
+        wid = 0x1000000 + i
+        props = {}
+        if i % 10:
+            vm = VM_NAMES[i % len(VM_NAMES)]
+            props['_QUBES_VMNAME'] = vm.encode()
+            props['_QUBES_LABEL'] = (i % 8 + 1).to_bytes(4, 'little')
+        else:
+            vm = 'dom0'
+        if i % 20 == 1:
+            props['WM_TRANSIENT_FOR'] = [wid - 1]
+        conn.properties[wid] = props
+        win = FakeClient(qtile, wid, f'{vm}: window {i}', group)
+        group.windows.append(win)
+        qtile.windows_map[wid] = win
+    group.current_window = group.windows[0] if group.windows else None
+    qtile.current_window = group.current_window
+    return group
+
+class Benchmark:
+
+    def __init__(self, qtile, conn, qubes, config, repeat):
+        self.qtile = qtile
+        self.conn = conn
+        self.qubes = qubes
+        self.config = config
+        self.repeat = repeat
+        self.results = []
+
+    def measure(self, scenario, windows, func):
+        ''' Run func and record its throughput.
+        :param func: Function doing some work and returning the number of operations it did.
+        '''
+        roundtrips = self.conn.roundtrips
+        waited = self.conn.waited
+        start = time.perf_counter()
+        ops = func()
+        duration = time.perf_counter() - start
+        roundtrips = self.conn.roundtrips - roundtrips
+        if not self.conn.sleep:
+            duration += self.conn.waited - waited
+        self.results.append((scenario, windows, ops, duration, roundtrips))
+
+    def run(self, count):
+        qubes = self.qubes
+        group = create_session(self.qtile, self.conn, count)
+        windows = group.windows
+        border = qubes.QubesBorder()
+
+        def compare_once():
+            for win in windows:
+                border.compare(win)
+            return len(windows)
+
+        def prefetch():
+            qubes.prefetch_properties([win.wid for win in windows])
+            return len(windows)
+
+        def compare():
+            for _ in range(self.repeat):
+                for win in windows:
+                    border.compare(win)
+            return self.repeat * len(windows)
+
+        qubes._property_cache.clear()
+        self.measure('compare (cold cache)', count, compare_once)
+        self.measure('compare (warm cache)', count, compare)
+
+        qubes._property_cache.clear()
+        self.measure('prefetch_properties', count, prefetch)
+
+        tasklist = qubes.QubesTaskList(border=border, title_width_method='uniform', icon_size=0)
+        bar = FakeBar(self.qtile, FakeScreen(group))
+        bar.widgets.append(tasklist)
+        tasklist._configure(self.qtile, bar)
+        tasklist.length = bar.width
+
+        def get_taskname():
+            for _ in range(self.repeat):
+                for win in windows:
+                    tasklist.get_taskname(win)
+            return self.repeat * len(windows)
+
+        def draw_full():
+            for _ in range(self.repeat):
+                tasklist._drawn = None
+                tasklist.draw()
+            return self.repeat
+
+        def draw_incremental():
+            for i in range(self.repeat):
+                win = windows[i % len(windows)]
+                win.name = f'{win.name[:-1]}{i % 10}'
+                tasklist.draw()
+            return self.repeat
+
+        self.measure('get_taskname', count, get_taskname)
+        self.measure('draw (full)', count, draw_full)
+        self.measure('draw (one title changed)', count, draw_incremental)
+
+        def new_windows():
+            #the same calls as qtile's Group.add() & client_managed
+            for win in windows:
+                win.can_steal_focus = True
+                self.config.decide_focus(group, win)
+                self.config.floating_layout.match(win)
+                self.config.disallow_focus_steal(win)
+            return len(windows)
+
+        qubes._snapshots.clear()
+        self.measure('new window (focus & float)', count, new_windows)
+
+    def report(self):
+        print(f'{"scenario":<28} {"windows":>7} {"ops":>7} {"ops/s":>12} {"roundtrips":>10} {"rt/op":>7}')
+        for scenario, windows, ops, duration, roundtrips in self.results:
+            rate = ops / duration if duration else float('inf')
+            print(f'{scenario:<28} {windows:>7} {ops:>7} {rate:>12.1f} {roundtrips:>10} {roundtrips / ops:>7.2f}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of qubes.py & the config.py hooks.')
+    parser.add_argument('--windows', default='10,100,1000', help='Comma-separated list of session sizes (default: %(default)s).')
+    parser.add_argument('--latency', type=float, default=100, help='Simulated X server round-trip latency in microseconds (default: %(default)s).')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of repetitions for warm scenarios (default: %(default)s).')
+    parser.add_argument('--sleep', action='store_true', help='Actually sleep for the latency instead of adding it to the measured time.')
+    args = parser.parse_args()
+
+    conn = FakeConnection(args.latency / 1e6, args.sleep)
+    qtile = FakeQtile(conn)
+    libqtile.init(qtile)
+
+    #qubes.py must be imported after the qtile object was set
+    qubes = load_module('libqtile.qubes', os.path.join(REPO_DIR, 'qubes.py'))
+    config = load_module('qubes_qtile_config', os.path.join(REPO_DIR, 'config.py'))
+
+    bench = Benchmark(qtile, conn, qubes, config, args.repeat)
+    for count in [int(c) for c in args.windows.split(',')]:
+        bench.run(count)
+    bench.report()
+
+if __name__ == '__main__':
+    main()
@@ -27,13 +27,10 @@
 
 #IMPORTANT: logs can be found at ~/.local/share/qtile/qtile.log
 
-import re
-import subprocess
-
-from libqtile import bar, layout, qtile, widget, hook
+from libqtile import layout, qtile, widget, hook
 from libqtile.config import Click, Drag, Group, Key, Match, Screen
 from libqtile.lazy import lazy
-from libqtile.qubes import QubesBorder, QubesTaskList
+from libqtile.qubes import DeferredWidget, QubesBar, QubesBattery, QubesBorder, QubesCalendar, QubesMatch, QubesTaskList, QubesVolume, SnapshotRules, focus_policy, get_qubes_pref, profiled, focus_next_in_vm, spawn_focused, take_screenshot, change_brightness
 #from libqtile.log_utils import logger #only errors are visible in the qtile log by default
 
 mod = "mod4"
@@ -62,7 +59,7 @@ keys = [
 
     # misc hotkeys
     Key([mod], "m", lazy.window.toggle_minimize()),
-    Key([mod], "Return", lazy.spawn(terminal), desc="Launch terminal"),
+    Key([mod], "Return", lazy.function(spawn_focused, terminal), desc="Launch terminal (its window takes the focus)"),
     Key([mod], "Tab", lazy.next_layout(), desc="Toggle between layouts"),
     Key([mod], "w", lazy.window.kill(), desc="Kill/Close focused window"),
     Key([mod, "shift"], "c", lazy.window.kill(), desc="Kill/Close focused window"),
@@ -75,44 +72,31 @@ keys = [
     #custom hotkeys
     Key([mod], "q", lazy.spawn("screenlock"), desc="Launch screen locker"),
     Key([mod], "e", lazy.spawn("qidled unpauseAllActiveWindows"), desc="Unpause active windows"),
-    Key([mod], "Print", lazy.spawn("mkdir -p ~/screenshots && maim ~/screenshots/$(date +%s).png", shell=True), desc="Take a screenshot"), #requires maim in dom0
-    #raise & lower volume, mute - requires qubes-wpctl (https://github.com/3hhh/qubes-terminal-hotkeys/tree/master/util) & blib (https://github.com/3hhh/blib) in dom0
-    Key([mod], "F7", lazy.spawn("qubes-wpctl toggle default"), desc="Toggle mute status"),
-    Key([mod], "F8", lazy.spawn("qubes-wpctl volumeOut 5%-"), desc="Decrease volume"),
-    Key([mod], "F9", lazy.spawn("qubes-wpctl volumeOut 5%+"), desc="Increase volume"),
+    Key([mod], "v", lazy.function(focus_next_in_vm), desc="Focus the next window of the current VM"),
+    Key([mod], "Print", lazy.function(take_screenshot), desc="Take a screenshot of the current screen (saved to ~/screenshots/)"),
+    Key([mod, "shift"], "Print", lazy.function(take_screenshot, 'window'), desc="Take a screenshot of the focused window"),
+    #raise & lower volume, mute via the volume widget (rapid changes are applied at once)
+    Key([mod], "F7", lazy.widget["volume"].mute(), desc="Toggle mute status"),
+    Key([mod], "F8", lazy.widget["volume"].decrease_vol(), desc="Decrease volume"),
+    Key([mod], "F9", lazy.widget["volume"].increase_vol(), desc="Increase volume"),
+    #requires qubes-wpctl (https://github.com/3hhh/qubes-terminal-hotkeys/tree/master/util) & blib (https://github.com/3hhh/blib) in dom0
     Key([mod], "F11", lazy.spawn("qubes-wpctl switchOut"), desc="Switch audio sink"),
-    #adjust brightness (requires brightnessctl in dom0)
-    Key([mod], "F1", lazy.spawn("brightnessctl set 2%-"), desc="Decrease screen brightness"),
-    Key([mod], "F2", lazy.spawn("brightnessctl set 2%+"), desc="Increase screen brightness"),
+    #adjust brightness (held keys are coalesced)
+    Key([mod], "F1", lazy.function(change_brightness, -2), desc="Decrease screen brightness"),
+    Key([mod], "F2", lazy.function(change_brightness, 2), desc="Increase screen brightness"),
 ]
 
-#whether or not to focus the next spawned window
-FOCUS_NEXT = False
-
-def focus_next():
-    global FOCUS_NEXT
-    FOCUS_NEXT = True
-
-#never let any new client steal focus unless explicitly allowed via decide_focus()
+#never let any new client steal focus unless explicitly allowed by the focus policy (empty screen, subwindow, focus token
+#from focus_policy.spawn() or focus_policy.grant())
 @hook.subscribe.group_window_add
+@profiled
 def decide_focus(group, win):
-    global FOCUS_NEXT
-
-    if not qtile.current_window: #empty screen
-        return
-
-    if win.is_transient_for() and qtile.current_window == win.is_transient_for(): #subwindow
-        return
-
-    if FOCUS_NEXT:
-        FOCUS_NEXT = False
-        return
-
-    #default: disallow focus steal from this window
-    win.can_steal_focus = False
+    if not focus_policy.allow_focus(win):
+        win.can_steal_focus = False
 
 #even if a focus steal was allowed, make sure it isn't allowed forever
 @hook.subscribe.client_managed
+@profiled
 def disallow_focus_steal(win):
     win.can_steal_focus = False
 
@@ -129,7 +113,7 @@ def warp_screen():
     qtile.warp_to_screen()
 
 groups = [Group(i) for i in "12345678" ]
-groups.append(Group('9', matches=[ Match(wm_class=re.compile(r'^chat:.*$')) ] )) #chat VM windows are always started in group 9
+groups.append(Group('9', matches=[ QubesMatch(vm='chat') ] )) #chat VM windows are always started in group 9
 
 for i in groups:
     keys.extend(
@@ -188,49 +172,49 @@ widget_defaults = dict(
 )
 extension_defaults = widget_defaults.copy()
 
-def open_ical():
-    focus_next()
-    qtile.spawn('terminal -e ical') #for whatever reason lazy doesn't work here!
+#calendar popup (like util/ical) opened by a click on the clock
+calendar = QubesCalendar(font=widget_defaults['font'], fontsize=widget_defaults['fontsize'])
 
-if subprocess.call('qubes-prefs default_audiovm', shell=True) == 'dom0':
-    vol_widget = widget.Volume(
-        fmt=r'Vol: {}',
-        mute_format=r'<span color="yellow">M</span>',
-        unmute_format=r'<span color="lime">{volume}%</span>',
-        )
-else:
+def set_audiovm(audiovm):
+    volume = qtile.widgets_map.get('volume')
+    if volume:
+        volume.set_audiovm(audiovm)
+
+#NOTE: the audio VM is read from a cache & refreshed in the background as qubesd may be slow to respond, changes are applied to the volume widget
+get_qubes_pref('default_audiovm', default='dom0', callback=set_audiovm)
+
+def volume_widget():
     #a non-dom0 audio VM currently requires qubes-wpctl (https://github.com/3hhh/qubes-terminal-hotkeys/tree/master/util) & blib (https://github.com/3hhh/blib) in dom0 for the volume widget
-    vol_widget = widget.Volume(
+    return QubesVolume(
+        name='volume',
         fmt=r'Vol: {}',
         mute_format=r'<span color="yellow">M</span>',
         unmute_format=r'<span color="lime">{volume}%</span>',
-        check_mute_command=r'qubes-wpctl printDefault | grep -E "^Out: .*MUTED.*$" &> /dev/null && echo "[off]"',
-        get_volume_command=r'qubes-wpctl printDefault | sed -rn "s/Out: .*\[vol: ([0-9]+)\.([0-9]+)\]$/\1\2%/p"',
-        mute_command=r'qubes-wpctl toggle default',
-        volume_up_command=r'qubes-wpctl volumeOut 5%+',
-        volume_down_command=r'qubes-wpctl volumeOut 5%-',
-        volume_app=r'qubes-wpctl app',
-        update_interval=30,
+        audiovm=get_qubes_pref('default_audiovm', default='dom0'),
         )
 
 screens = [ Screen(
-        top=bar.Bar(
+        #NOTE: QubesBar only repaints the widgets that changed (e.g. the clock every second)
+        top=QubesBar(
             [
-                widget.LaunchBar(progs = [('/usr/share/icons/hicolor/16x16/apps/qubes-logo-icon.png', \
-                    'qubes-app-menu', 'Qubes OS menu'),]),
+                #NOTE: DeferredWidget creates its widget after the bar was drawn for the first time, i.e. it doesn't delay the startup
+                DeferredWidget(lambda: widget.LaunchBar(progs = [('/usr/share/icons/hicolor/16x16/apps/qubes-logo-icon.png', \
+                    'qubes-app-menu', 'Qubes OS menu'),])),
                 widget.GroupBox(highlight_method='block'),
                 widget.Prompt(bell_style="visual"),
                 QubesTaskList(title_width_method='uniform', border=border),
                 # NB Systray is incompatible with Wayland, consider using StatusNotifier instead
                 # widget.StatusNotifier(),
                 #widget.KeyboardLayout(),
+                #QubesDomains(), #running qubes (dom0 only, import QubesDomains from libqtile.qubes)
                 widget.Systray(),
-                widget.Battery(format='Bat({char}): {percent:2.0%} {hour:d}:{min:02d}h {watt:.2f}W', show_short_text=False),
+                DeferredWidget(lambda: QubesBattery(format='Bat({char}): {percent:2.0%} {hour:d}:{min:02d}h {watt:.2f}W', show_short_text=False)),
                 widget.Sep(padding=10),
-                vol_widget,
+                #QubesBacklight(fmt='Bri: {}'), widget.Sep(padding=10), #brightness (laptops, import QubesBacklight from libqtile.qubes)
+                DeferredWidget(volume_widget),
                 widget.Sep(padding=10),
-                widget.Clock(format="%a %b %d %H:%M:%S", mouse_callbacks={'Button1': open_ical}),
-                widget.CurrentLayout(mode='icon'),
+                widget.Clock(format="%a %b %d %H:%M:%S", mouse_callbacks={'Button1': calendar.toggle}),
+                DeferredWidget(lambda: widget.CurrentLayout(mode='icon')),
             ],
             24,
             # border_width=[2, 0, 2, 0],  # Draw top and bottom borders
@@ -262,7 +246,8 @@ floating_layout = layout.Floating( #NOTE: this cannot be disabled, so we better
     max_border_width = border_width,
     border_normal = border,
     border_focus = border,
-    float_rules=[
+    #NOTE: SnapshotRules evaluates all rules against properties fetched once per window
+    float_rules=[ SnapshotRules([
         # Run the utility of `xprop` to see the wm class and name of an X client.
         *layout.Floating.default_float_rules,
         Match(func=lambda c: bool(c.is_transient_for())), #these are usually context menus, menu bars, ...
@@ -272,7 +257,7 @@ floating_layout = layout.Floating( #NOTE: this cannot be disabled, so we better
         Match(wm_class="ssh-askpass"),  # ssh-askpass
         Match(title="branchdialog"),  # gitk
         Match(title="pinentry"),  # GPG key password entry
-    ]
+    ]) ]
 )
 auto_fullscreen = False
 focus_on_window_activation = "never"
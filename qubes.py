@@ -20,11 +20,271 @@
 #
 
 import asyncio
+import calendar
+import contextlib
+import datetime
+import functools
+import html
+import json
+import math
+import os
+import re
+import shlex
+import shutil
+import sys
+import time
+import weakref
+from collections import deque
 
-from libqtile import hook
-from libqtile.widget import TaskList
+from libqtile import bar, configurable, hook, qtile, utils
+from libqtile.widget import TaskList, Volume, base
+from libqtile.widget.battery import Battery, BatteryState, BatteryStatus, _Battery
+from libqtile.command.base import expose_command
+from libqtile.config import Match
 from libqtile.confreader import ConfigError
+from libqtile.log_utils import logger
+from libqtile.utils import create_task
+
+# profiling
+# Profiling is enabled by setting this environment variable for qtile. Its value is the interval in seconds to log the
+# statistics at (0: never). The statistics are also available via `qtile cmd-obj -f qubes_stats`.
+QUBES_PROFILE_ENV = 'QTILE_QUBES_PROFILE'
+
+# number of latency samples to keep per profiled function (older samples are dropped)
+PROFILE_SAMPLES = 4096
+
+def _profile_interval():
+    value = os.environ.get(QUBES_PROFILE_ENV)
+    if value is None:
+        return None
+    try:
+        return max(float(value or 0), 0)
+    except ValueError:
+        logger.warning('Invalid value for %s: %s', QUBES_PROFILE_ENV, value)
+        return 0
+
+PROFILE_INTERVAL = _profile_interval()
+
+_profile_stats = {} #profiled function name --> ProfileStats
+_roundtrips = 0 #X server round-trips since the start of qtile (only counted with profiling)
+
+class ProfileStats:
+    ''' Call statistics of a profiled function. Latencies include the time spent in nested profiled functions. '''
+
+    def __init__(self):
+        self.samples = deque(maxlen=PROFILE_SAMPLES)
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.roundtrips = 0
+        self.total = 0
+        self.samples.clear()
+
+    def add(self, duration, roundtrips):
+        self.calls += 1
+        self.roundtrips += roundtrips
+        self.total += duration
+        self.samples.append(duration)
+
+    def as_dict(self):
+        ''' Get the statistics with all latencies in milliseconds.
+            Percentiles and the maximum are computed from the last PROFILE_SAMPLES calls only.
+        '''
+        samples = sorted(self.samples)
+
+        def percentile(p):
+            if not samples:
+                return 0
+            return samples[min(int(p * len(samples)), len(samples) - 1)] * 1000
+
+        return {
+            'calls': self.calls,
+            'roundtrips': self.roundtrips,
+            'roundtrips_per_call': self.roundtrips / self.calls if self.calls else 0,
+            'total_ms': self.total * 1000,
+            'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99),
+            'max_ms': samples[-1] * 1000 if samples else 0,
+        }
+
+def count_roundtrips(count=1):
+    ''' Record X server round-trips for the profiled functions that are currently running. '''
+    global _roundtrips
+    _roundtrips += count
+
+def profiled(func):
+    ''' Decorator to record the number of calls, the X server round-trips and the latencies of a function.
+        Without profiling the function is returned unchanged, i.e. there is no overhead.
+    '''
+    if PROFILE_INTERVAL is None:
+        return func
+
+    stats = _profile_stats.setdefault(func.__qualname__, ProfileStats())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        roundtrips = _roundtrips
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.add(time.perf_counter() - start, _roundtrips - roundtrips)
+
+    return wrapper
+
+def get_profile_stats(reset=False):
+    ''' Get the profiling statistics.
+    :param reset: Whether to reset the statistics afterwards, e.g. to measure the effect of a change.
+    :return: dict of profiled function names to dicts of statistics or an empty dict, if profiling is disabled.
+    '''
+    ret = {name: stats.as_dict() for name, stats in sorted(_profile_stats.items()) if stats.calls}
+    if reset:
+        for stats in _profile_stats.values():
+            stats.reset()
+    return ret
+
+def qubes_stats(manager, reset=False):
+    ''' Return the statistics of the functions profiled by qubes.py (requires the QTILE_QUBES_PROFILE environment variable).
+    :param reset: Whether to reset the statistics afterwards.
+    '''
+    if isinstance(reset, str): #qtile cmd-obj passes strings
+        reset = reset.lower() in ['1', 'true', 'yes']
+    return get_profile_stats(reset)
+
+def log_profile_stats():
+    for name, stats in get_profile_stats().items():
+        #NOTE: the default qtile log level only shows warnings & errors
+        logger.warning('profile: %s calls=%d roundtrips=%d total=%.1fms p50=%.3fms p99=%.3fms max=%.3fms', name, stats['calls'],
+            stats['roundtrips'], stats['total_ms'], stats['p50_ms'], stats['p99_ms'], stats['max_ms'])
+
+def _log_profile_stats_periodically():
+    log_profile_stats()
+    asyncio.get_running_loop().call_later(PROFILE_INTERVAL, _log_profile_stats_periodically)
+
+def _install_profiling():
+    ''' Count the X server round-trips of qtile X11 windows, expose the qubes_stats command & start the periodic log dump. '''
+    if PROFILE_INTERVAL is None:
+        return
+
+    try:
+        from libqtile.backend.x11.window import XWindow
+    except ImportError: #not running on X11
+        XWindow = None
+
+    #NOTE: these methods wait for a reply from the X server, most others don't
+    for method in ['get_property', 'get_geometry', 'get_attributes', 'query_tree', 'list_properties'] if XWindow else []:
+        func = getattr(XWindow, method)
+        if getattr(func, 'qubes_wrapped', False):
+            continue
+
+        def wrapper(*args, func=func, **kwargs):
+            count_roundtrips()
+            return func(*args, **kwargs)
+
+        wrapper.qubes_wrapped = True
+        setattr(XWindow, method, functools.update_wrapper(wrapper, func))
+
+    #root command: qtile passes the Qtile object as first argument to unbound commands
+    commands = getattr(qtile, '_commands', None)
+    if commands is None: #e.g. qtile check
+        return
+    commands['qubes_stats'] = expose_command()(qubes_stats)
+
+    if PROFILE_INTERVAL:
+        try:
+            asyncio.get_running_loop().call_later(PROFILE_INTERVAL, _log_profile_stats_periodically)
+        except RuntimeError: #no event loop
+            pass
+
+_install_profiling()
+
+# startup profiling
+# Setting this environment variable for qtile logs the time taken by module imports, widget construction & configuration
+# until qtile has started.
+QUBES_STARTUP_PROFILE_ENV = 'QTILE_QUBES_STARTUP_PROFILE'
+
+# minimum time in seconds for an import to be logged
+STARTUP_PROFILE_MIN = 0.001
+
+STARTUP_PROFILE = bool(os.environ.get(QUBES_STARTUP_PROFILE_ENV))
+
+_startup_begin = time.perf_counter()
+
+def record_startup_time(kind, name, duration):
+    ''' Log a startup timing (startup profiling only).
+    :param kind: Kind of the timing, e.g. 'import' or 'widget'.
+    '''
+    if STARTUP_PROFILE and (kind != 'import' or duration >= STARTUP_PROFILE_MIN):
+        #NOTE: the default qtile log level only shows warnings & errors
+        logger.warning('startup: %s %s took %.1fms (at %.1fms)', kind, name, duration * 1000, (time.perf_counter() - _startup_begin) * 1000)
+
+@contextlib.contextmanager
+def startup_timer(kind, name):
+    ''' Context manager to record the time taken by its body with record_startup_time(). '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup_time(kind, name, time.perf_counter() - start)
+
+class _TimedLoader:
+    ''' Wrapper around a module loader to measure the module execution time (including nested imports). '''
+
+    def __init__(self, loader):
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        with startup_timer('import', module.__name__):
+            self._loader.exec_module(module)
+
+class _ImportTimer:
+    ''' Meta path finder measuring the execution time of all modules imported afterwards. '''
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = _TimedLoader(spec.loader)
+            return spec
+        return None
+
+def _startup_complete():
+    sys.meta_path[:] = [finder for finder in sys.meta_path if not isinstance(finder, _ImportTimer)]
+    record_startup_time('qtile', 'startup', time.perf_counter() - _startup_begin)
+
+def _install_startup_profiling():
+    ''' Measure imports, widget configuration & the total startup time. '''
+    if not STARTUP_PROFILE or any(isinstance(finder, _ImportTimer) for finder in sys.meta_path):
+        return
+    sys.meta_path.insert(0, _ImportTimer())
+    hook.subscribe.startup_complete(_startup_complete)
+
+    from libqtile.bar import Bar
+    configure_widget = Bar._configure_widget
+
+    def _configure_widget(self, widget):
+        with startup_timer('configure', widget.name):
+            return configure_widget(self, widget)
+
+    Bar._configure_widget = _configure_widget
+
+_install_startup_profiling()
+
+#NOTE: not lazily imported as the module must be loaded before the startup_once hook to inject the border drawing code
+#      into qtile
 from qtile_extras.layout.decorations import ConditionalBorder #https://qtile-extras.readthedocs.io/en/stable/manual/ref/borders.html
+from qtile_extras.layout.decorations.borders import _BorderStyle
 
 # _QUBES_LABEL xprop definitions
 QUBES_IND2LABEL = {
@@ -38,20 +298,209 @@ QUBES_IND2LABEL = {
     8: 'black',
 }
 
+# Qubes xprop name --> xprop type
+QUBES_PROPERTIES = {
+    '_QUBES_VMNAME': 'STRING',
+    '_QUBES_LABEL': 'CARDINAL',
+}
+
+# per-window cache of the Qubes xprops: window ID --> {xprop name: parsed value}
+# A missing xprop name means that the property wasn't fetched yet or was invalidated.
+_property_cache = {}
+
+# window registry: indexes of the property cache for fast lookups of all windows of a VM or label
+# VM name (None for dom0) --> set of window IDs
+_vm_index = {}
+# label index (None for dom0) --> set of window IDs
+_label_index = {}
+_indexes = {
+    '_QUBES_VMNAME': _vm_index,
+    '_QUBES_LABEL': _label_index,
+}
+
+# xprops of a WindowSnapshot
+SNAPSHOT_PROPERTIES = {
+    'WM_TRANSIENT_FOR': 'WINDOW',
+    '_NET_WM_WINDOW_TYPE': 'ATOM',
+    '_NET_WM_PID': 'CARDINAL',
+    '_NET_WM_STATE': 'ATOM',
+}
+
+# window ID --> WindowSnapshot
+_snapshots = {}
+
+# IDs of windows, which were prefetched without xprops before qtile managed them (they may be set until the window is mapped)
+_unmanaged_wids = set()
+
+# whether the qtile startup hook was fired (the module isn't reloaded on config reloads)
+_started = False
+
+def _parse_property(name, reply):
+    ''' Parse a GetPropertyReply for one of the QUBES_PROPERTIES.
+    :return: VM name for _QUBES_VMNAME, label index for _QUBES_LABEL or None, if the property is not set.
+    '''
+    if not reply or not reply.value_len:
+        return None
+    if name == '_QUBES_VMNAME':
+        return reply.value.to_string()
+    return int.from_bytes(reply.value[0])
+
+def _get_cached_property(client, name):
+    ''' Get a Qubes xprop of a client from the cache. Only cache misses cause an X server round-trip. '''
+    try:
+        return _property_cache[client.wid][name]
+    except KeyError:
+        pass
+    value = _parse_property(name, client.window.get_property(name, QUBES_PROPERTIES[name]))
+    _store_property(client.wid, name, value)
+    return value
+
+def _store_property(wid, name, value):
+    ''' Put a Qubes xprop into the cache and the window registry. '''
+    props = _property_cache.setdefault(wid, {})
+    _unindex_property(wid, name, props)
+    props[name] = value
+    _indexes[name].setdefault(value, set()).add(wid)
+
+def _unindex_property(wid, name, props):
+    if name not in props:
+        return
+    index = _indexes[name]
+    wids = index.get(props[name])
+    if wids is not None:
+        wids.discard(wid)
+        if not wids:
+            del index[props[name]]
+
+def invalidate_properties(wid, name=None):
+    ''' Remove Qubes xprops from the cache.
+    :param wid: Window ID.
+    :param name: xprop name to remove or None to remove all xprops of that window.
+    '''
+    props = _property_cache.get(wid)
+    if props is None:
+        return
+    for prop in [name] if name else list(props):
+        _unindex_property(wid, prop, props)
+        props.pop(prop, None)
+    if not props:
+        del _property_cache[wid]
+
+@profiled
+def prefetch_properties(wids=None):
+    ''' Fetch the Qubes xprops of many windows with the latency of a single X server round-trip.
+        All GetProperty requests are sent before the first reply is read. Windows with fully cached xprops are skipped.
+    :param wids: Iterable of window IDs. Default: all top-level windows.
+    '''
+    if qtile.core.name != 'x11': #e.g. qtile check
+        return
+
+    import xcffib.xproto
+    conn = qtile.core.conn
+    unmanaged = wids is None
+    if unmanaged:
+        wids = conn.default_screen.root.query_tree()
+
+    cookies = []
+    for wid in wids:
+        props = _property_cache.get(wid, {})
+        for name, prop_type in QUBES_PROPERTIES.items():
+            if name not in props:
+                cookie = conn.conn.core.GetProperty(False, wid, conn.atoms[name], conn.atoms[prop_type], 0, (2**32) - 1)
+                cookies.append((wid, name, cookie))
+    if cookies:
+        count_roundtrips()
+
+    for wid, name, cookie in cookies:
+        try:
+            reply = cookie.reply()
+        except (xcffib.xproto.WindowError, xcffib.xproto.AccessError): #window is gone
+            continue
+        value = _parse_property(name, reply)
+        _store_property(wid, name, value)
+        if value is None and unmanaged and wid not in qtile.windows_map:
+            _unmanaged_wids.add(wid)
+
+def _cache_properties(client):
+    ''' Fill the property cache for a new client. xprops prefetched before qtile managed the window are fetched again as
+        qtile doesn't receive PropertyNotify events for unmanaged windows.
+    '''
+    if client.wid in _unmanaged_wids:
+        _unmanaged_wids.discard(client.wid)
+        invalidate_properties(client.wid)
+    prefetch_properties([client.wid])
+
+def _uncache_properties(client):
+    invalidate_properties(client.wid)
+    _snapshots.pop(client.wid, None)
+
+def _prune_cache():
+    ''' Remove the xprops of windows that were prefetched, but aren't managed by qtile. '''
+    for wid in _property_cache.keys() - qtile.windows_map.keys():
+        invalidate_properties(wid)
+    _unmanaged_wids.clear()
+
+def _on_startup():
+    global _started
+    _started = True
+    _prune_cache()
+
+def _init_cache():
+    ''' Subscribe the hooks maintaining the property cache and prefetch the xprops of all existing windows.
+        Must be called on every config load as qtile clears all hooks on config reloads. Calling it twice is cheap.
+    '''
+    hook.subscribe.client_new(_cache_properties)
+    hook.subscribe.client_managed(_cache_properties)
+    hook.subscribe.client_killed(_uncache_properties)
+    hook.subscribe.startup(_on_startup)
+    prefetch_properties()
+    #NOTE: config reloads don't fire the startup hook, all windows to manage are already managed then
+    if _started:
+        _prune_cache()
+
+def _install_property_notify_handler():
+    ''' Wrap the qtile X11 PropertyNotify handler to refresh changed Qubes xprops in the cache & the window registry.
+        qtile doesn't provide a hook for property changes.
+    '''
+    try:
+        from libqtile.backend.x11.window import Window
+    except ImportError: #not running on X11
+        return
+
+    handler = getattr(Window, 'handle_PropertyNotify', None)
+    if handler is None:
+        #qtile renamed its handler: keep working with possibly outdated xprops (Qubes OS sets them on window creation)
+        logger.warning('qtile has no Window.handle_PropertyNotify, changes of the Qubes xprops will not be noticed.')
+        return
+    if getattr(handler, 'qubes_wrapped', False):
+        return
+
+    def handle_PropertyNotify(self, e):
+        name = self.qtile.core.conn.atoms.get_name(e.atom)
+        if name in QUBES_PROPERTIES:
+            invalidate_properties(self.wid, name)
+            prefetch_properties([self.wid]) #keep the window registry up to date
+        elif name in SNAPSHOT_PROPERTIES or name == 'WM_CLASS':
+            _snapshots.pop(self.wid, None)
+        return handler(self, e)
+
+    handle_PropertyNotify.qubes_wrapped = True
+    Window.handle_PropertyNotify = handle_PropertyNotify
+
+_install_property_notify_handler()
+_init_cache()
+
 def get_vm_name(client):
     ''' Get the VM name for a client.
     :return: VM name string or None, if it couldn't be identified (usually dom0).
     '''
-    prop = client.window.get_property('_QUBES_VMNAME', 'STRING')
-    if prop:
-        return prop.value.to_string()
-    return None
+    return _get_cached_property(client, '_QUBES_VMNAME')
 
 def get_border_color_index(client, default=None):
-    prop = client.window.get_property('_QUBES_LABEL', 'CARDINAL')
-    if prop:
-        return int.from_bytes(prop.value[0])
-    return default
+    ind = _get_cached_property(client, '_QUBES_LABEL')
+    if ind is None:
+        return default
+    return ind
 
 def get_border_color(client, dom0='black'):
     ''' Get the border color for a client.
@@ -63,6 +512,295 @@ def get_border_color(client, dom0='black'):
         return QUBES_IND2LABEL[ind]
     return dom0
 
+def _registry_windows(index, key):
+    ''' Map the window IDs of a window registry entry to the clients managed by qtile. '''
+    ret = []
+    for wid in index.get(key, ()):
+        client = qtile.windows_map.get(wid)
+        if client is not None:
+            ret.append(client)
+    return ret
+
+def get_vm_windows(vm):
+    ''' Get all windows of a VM from the window registry without any X server round-trip.
+    :param vm: VM name. 'dom0' or None for dom0 windows.
+    :return: List of the clients of that VM sorted by window ID (not necessarily their creation order).
+    '''
+    if vm == 'dom0':
+        vm = None
+    return sorted(_registry_windows(_vm_index, vm), key=lambda c: c.wid)
+
+def get_label_windows(label):
+    ''' Get all windows with a label from the window registry without any X server round-trip.
+    :param label: Label name (e.g. 'red') or index. 'dom0' or None for dom0 windows.
+    :return: List of the clients with that label sorted by window ID (not necessarily their creation order).
+    '''
+    if label == 'dom0':
+        label = None
+    elif isinstance(label, str):
+        label = next((ind for ind, name in QUBES_IND2LABEL.items() if name == label), -1)
+    return sorted(_registry_windows(_label_index, label), key=lambda c: c.wid)
+
+def get_vms():
+    ''' Get the names of all VMs with managed windows. dom0 is included as 'dom0'. '''
+    return {vm or 'dom0' for vm, wids in _vm_index.items() if any(wid in qtile.windows_map for wid in wids)}
+
+def kill_vm_windows(qtile, vm):
+    ''' Close all windows of a VM, e.g. via `lazy.function(kill_vm_windows, 'work')`. '''
+    for client in get_vm_windows(vm):
+        client.kill()
+
+def focus_next_in_vm(qtile, vm=None):
+    ''' Focus the next window of a VM, switching groups if necessary, e.g. via `lazy.function(focus_next_in_vm)`.
+    :param vm: VM name. Default: The VM of the current window.
+    '''
+    current = qtile.current_window
+    if vm is None:
+        if current is None:
+            return
+        vm = get_vm_name(current)
+    windows = [c for c in get_vm_windows(vm) if c.group is not None]
+    if not windows:
+        return
+    current_wid = current.wid if current else -1
+    client = next((c for c in windows if c.wid > current_wid), windows[0])
+    if client is current:
+        return
+    if client.group is not qtile.current_group:
+        client.group.toscreen()
+    client.group.focus(client)
+
+class WindowSnapshot:
+    ''' The transient-for window, window type, PID, taskbar state & class of a client fetched with a single X server round-trip.
+        It can be passed to qtile Match objects & functions instead of the client: All other attributes are taken from the
+        client.
+    '''
+
+    def __init__(self, client, transient_for, wm_type, pid, skip_taskbar=False):
+        '''
+        :param transient_for: Window ID of the parent window or None.
+        :param wm_type: Window type as returned by qtile's get_wm_type(), e.g. 'dialog'.
+        :param pid: Process ID from _NET_WM_PID or None.
+        :param skip_taskbar: Whether _NET_WM_STATE contains _NET_WM_STATE_SKIP_TASKBAR.
+        '''
+        self.client = client
+        self.transient_for = transient_for
+        self.wm_type = wm_type
+        self.pid = pid
+        self.skip_taskbar = skip_taskbar
+        self.wm_class = client.get_wm_class()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_wm_type(self):
+        return self.wm_type
+
+    def get_wm_class(self):
+        return self.wm_class
+
+    def get_pid(self):
+        return self.pid
+
+    def is_transient_for(self):
+        return qtile.windows_map.get(self.transient_for)
+
+def _parse_first(reply):
+    ''' Parse the first 32 bit value of a GetPropertyReply (e.g. window ID, cardinal).
+    :return: The value or None, if the property is not set.
+    '''
+    if not reply or not reply.value_len:
+        return None
+    return reply.value.to_atoms()[0]
+
+def _parse_wm_type(conn, reply):
+    ''' Parse a _NET_WM_WINDOW_TYPE GetPropertyReply the same way qtile's XWindow.get_wm_type() does. '''
+    from libqtile.backend.x11.xcbq import WindowTypes
+    if not reply or not reply.value_len:
+        return None
+    names = [conn.atoms.get_name(atom) for atom in reply.value.to_atoms()]
+    for name in names:
+        if name in WindowTypes:
+            return WindowTypes[name]
+    return names[0]
+
+def _parse_skip_taskbar(conn, reply):
+    ''' Check whether a _NET_WM_STATE GetPropertyReply contains _NET_WM_STATE_SKIP_TASKBAR. '''
+    if not reply or not reply.value_len:
+        return False
+    return conn.atoms['_NET_WM_STATE_SKIP_TASKBAR'] in reply.value.to_atoms()
+
+def get_snapshot(client):
+    ''' Get the WindowSnapshot of a client. Snapshots are cached until the client is killed or one of its SNAPSHOT_PROPERTIES
+        or its class change.
+    '''
+    try:
+        return _snapshots[client.wid]
+    except KeyError:
+        pass
+
+    if qtile.core.name != 'x11':
+        parent = client.is_transient_for()
+        snapshot = WindowSnapshot(client, parent.wid if parent else None, client.get_wm_type(), client.get_pid())
+    else:
+        import xcffib.xproto
+        conn = qtile.core.conn
+        cookies = {name: conn.conn.core.GetProperty(False, client.wid, conn.atoms[name], conn.atoms[prop_type], 0, (2**32) - 1)
+                   for name, prop_type in SNAPSHOT_PROPERTIES.items()}
+        count_roundtrips()
+        replies = {}
+        for name, cookie in cookies.items():
+            try:
+                replies[name] = cookie.reply()
+            except (xcffib.xproto.WindowError, xcffib.xproto.AccessError): #window is gone
+                replies[name] = None
+        transient = _parse_first(replies['WM_TRANSIENT_FOR'])
+        snapshot = WindowSnapshot(client, transient, _parse_wm_type(conn, replies['_NET_WM_WINDOW_TYPE']), _parse_first(replies['_NET_WM_PID']),
+                                  _parse_skip_taskbar(conn, replies['_NET_WM_STATE']))
+
+    _snapshots[client.wid] = snapshot
+    return snapshot
+
+class SnapshotRules(Match):
+    ''' Match a window, if any of the given qtile Match objects matches its WindowSnapshot.
+        Use it as the only float rule to evaluate all float rules with a single X server round-trip, e.g.
+        `layout.Floating(float_rules=[SnapshotRules([*layout.Floating.default_float_rules, Match(wm_class='ssh-askpass')])])`.
+    '''
+
+    def __init__(self, rules):
+        Match.__init__(self)
+        self.rules = list(rules)
+
+    @profiled
+    def compare(self, client):
+        snapshot = get_snapshot(client)
+        return any(rule.compare(snapshot) for rule in self.rules)
+
+    def __repr__(self):
+        return f"<SnapshotRules({self.rules!r})>"
+
+# default lifetime of focus tokens in seconds
+FOCUS_TOKEN_TIMEOUT = 10
+
+# maximum number of parent processes of a window's process to check for a focus token (0: the process itself only)
+FOCUS_TOKEN_DEPTH = 3
+
+class FocusPolicy:
+    ''' Decide whether new windows may take the focus. By default they may not, unless
+        - there is no focused window,
+        - they are a transient window (e.g. a dialog or menu) of the focused window or
+        - a focus token was granted for them, e.g. by spawn().
+        Focus tokens are scoped to a process ID (including its child processes up to FOCUS_TOKEN_DEPTH levels, dom0 windows
+        only) or a WM_CLASS, expire after a deadline and can be used only once.
+    '''
+
+    def __init__(self):
+        self._pid_tokens = {} #PID --> deadline (time.monotonic())
+        self._class_tokens = {} #WM_CLASS entry --> deadline
+
+    def _prune(self):
+        now = time.monotonic()
+        for tokens in [self._pid_tokens, self._class_tokens]:
+            for key in [key for key, deadline in tokens.items() if deadline < now]:
+                del tokens[key]
+
+    def grant(self, pid=None, wm_class=None, timeout=None):
+        ''' Allow the next window of a process or with a WM_CLASS to take the focus.
+        :param pid: Process ID. Windows of its child processes (up to FOCUS_TOKEN_DEPTH levels) are allowed as well.
+        :param wm_class: WM_CLASS instance or class name, e.g. 'work:firefox' for a firefox window from the VM work.
+        :param timeout: Lifetime of the token in seconds (default: FOCUS_TOKEN_TIMEOUT).
+        '''
+        self._prune()
+        deadline = time.monotonic() + (FOCUS_TOKEN_TIMEOUT if timeout is None else timeout)
+        if pid is not None and pid > 0:
+            self._pid_tokens[pid] = deadline
+        if wm_class is not None:
+            self._class_tokens[wm_class] = deadline
+
+    def spawn(self, cmd, wm_class=None, timeout=None, shell=False):
+        ''' Spawn a command and allow its next window to take the focus.
+        :param wm_class: WM_CLASS to grant a token for in addition to the PID, e.g. for applications that reuse a running
+                         process.
+        :return: PID of the spawned process or -1 on errors.
+        '''
+        pid = qtile.spawn(cmd, shell=shell)
+        self.grant(pid=pid, wm_class=wm_class, timeout=timeout)
+        return pid
+
+    @staticmethod
+    def _parent_pid(pid):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                #the command may contain spaces and brackets
+                return int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _take(self, tokens, key, now):
+        deadline = tokens.pop(key, None)
+        return deadline is not None and deadline >= now
+
+    def consume(self, snapshot):
+        ''' Use the focus token of a window, if there is any.
+        :param snapshot: WindowSnapshot of the window.
+        :return: Whether the window may take the focus.
+        '''
+        if not self._pid_tokens and not self._class_tokens:
+            return False
+        now = time.monotonic()
+        for wm_class in snapshot.get_wm_class() or []:
+            if self._take(self._class_tokens, wm_class, now):
+                return True
+
+        #NOTE: VM windows may set any PID, which is meaningless in dom0 anyway
+        pid = snapshot.get_pid() if get_vm_name(snapshot.client) is None else None
+        for depth in range(FOCUS_TOKEN_DEPTH + 1):
+            if not self._pid_tokens or not pid or pid <= 1:
+                break
+            if self._take(self._pid_tokens, pid, now):
+                return True
+            if depth < FOCUS_TOKEN_DEPTH:
+                pid = self._parent_pid(pid)
+        return False
+
+    def allow_focus(self, win):
+        ''' Decide whether a new window may take the focus. Should be called from the group_window_add hook.
+        :return: Whether the window may take the focus.
+        '''
+        current = qtile.current_window
+        if not current: #empty screen
+            return True
+
+        snapshot = get_snapshot(win) #NOTE: the snapshot is re-used by SnapshotRules
+        if current == snapshot.is_transient_for(): #subwindow
+            return True
+        return self.consume(snapshot)
+
+# focus policy of this qtile session (it persists across config reloads)
+focus_policy = FocusPolicy()
+
+def spawn_focused(qtile, cmd, wm_class=None):
+    ''' Spawn a command and allow its next window to take the focus, e.g. via `lazy.function(spawn_focused, 'terminal')`. '''
+    focus_policy.spawn(cmd, wm_class=wm_class)
+
+class _PixelBorder(_BorderStyle):
+    ''' Solid X11 border with a preallocated pixel value, i.e. painting it doesn't require any X server round-trip for the
+        color (qtile allocates the colors of string borders on every paint).
+    '''
+
+    needs_surface = False
+
+    def __init__(self, pixel):
+        _BorderStyle.__init__(self)
+        self.pixel = pixel
+
+    #override to avoid the window attribute round-trip of _BorderStyle._x11_draw()
+    def _x11_draw(self, window, depth, pixmap, gc, outer_w, outer_h, borderwidth, x, y, width, height):
+        import xcffib.xproto
+        core = window.conn.conn.core
+        core.ChangeGC(gc, xcffib.xproto.GC.Foreground, [self.pixel])
+        core.PolyFillRectangle(pixmap, gc, 1, [xcffib.xproto.RECTANGLE.synthetic(x, y, width, height)])
+
 class QubesBorder(ConditionalBorder):
     ''' Use this class as border decoration for focused and unfocused windows on Qubes OS to color windows according
         to their Qube/VM label.
@@ -83,13 +821,14 @@ class QubesBorder(ConditionalBorder):
 
     defaults = [
         ("colors", color_defaults, "Map of color names (e.g. 'green') to list of RGB color definitions used for drawing (first item is for unfocused windows, second for focused windows)."),
-        ("fallback", "#FFFFFF", "Border color to use on errors (RGB hex)."),
+        ("fallback", "#FFFFFF", "Border color to use on errors."),
         ("dom0", "black", "Border color to use for dom0 (color name)."),
     ]
 
     def __init__(self, **config):
         ConditionalBorder.__init__(self, **config)
         self.add_defaults(self.defaults)
+        _init_cache()
 
         if not self.colors or not isinstance(self.colors, dict):
             raise ConfigError("Color map is not set or of an incorrect type.")
@@ -98,69 +837,1964 @@ class QubesBorder(ConditionalBorder):
             if not isinstance(color, list) or len(color) != 2:
                 raise ConfigError("Unexpected color map contents. Each entry must be a list of exactly 2 colors (unfocused/focused).")
 
+        #NOTE: a config reload creates a new instance and thus new tables
+        self._resolved = {} #color --> (RGB hex color, border)
+        self.color_table, self.border_table = self._build_color_tables()
+        self._fallback = self._resolve_color(self.fallback)
+
+    def _resolve_color(self, color):
+        ''' Resolve a color as accepted by qtile's X11 color_pixel() (e.g. RGB hex or X color names such as 'darkred').
+            On X11 its pixel value is allocated only once.
+        :return: Tuple (RGB hex color for qtile drawers, border for qtile's paint_borders()).
+        '''
+        try:
+            return self._resolved[color]
+        except KeyError:
+            pass
+
+        if qtile.core.name != 'x11': #e.g. qtile check
+            ret = (color, color)
+        else:
+            pixel = qtile.core.conn.color_pixel(color)
+            try:
+                utils.rgb(color)
+                rgb = color
+            except ValueError: #X color name (TrueColor visual)
+                rgb = f'#{pixel & 0xFFFFFF:06x}'
+            ret = (rgb, _PixelBorder(pixel))
+        self._resolved[color] = ret
+        return ret
+
+    def _build_color_tables(self):
+        ''' Build the lookup tables used by get_color() & compare().
+        :return: Tuple (RGB hex colors, borders) of immutable tables to be indexed by [label index][focused]. Index 0 is
+                 used for dom0.
+        '''
+        fallback = [self.fallback, self.fallback]
+        table = [self.colors.get(self.dom0, fallback)]
+        for ind in range(1, max(QUBES_IND2LABEL) + 1):
+            table.append(self.colors.get(QUBES_IND2LABEL.get(ind), fallback))
+        resolved = [[self._resolve_color(color) for color in colors] for colors in table]
+        return (tuple(tuple(rgb for rgb, _ in colors) for colors in resolved),
+                tuple(tuple(border for _, border in colors) for colors in resolved))
+
+    @profiled
     def compare(self, win):
         ''' Override ConditionalBorder.compare().
             We just use it to get access to the window.
-        :return: RGB border color as needed by qtile, e.g. 'fff'.
+        :return: Border as needed by qtile's paint_borders(): a solid border with a preallocated pixel value on X11.
         '''
         if not win:
-            return self.fallback
+            return self._fallback[1]
+        try:
+            return self.border_table[get_border_color_index(win, 0)][win.has_focus]
+        except IndexError: #unknown label
+            return self._fallback[1]
 
-        color = get_border_color(win, dom0=self.dom0)
-        if not color:
-            return self.fallback
+    def get_color(self, win, focused):
+        ''' Get the border color of a window independent of its current focus state.
+        :param focused: Whether to return the color for focused or unfocused windows.
+        :return: RGB hex border color as needed by qtile drawers, e.g. '#ffffff'.
+        '''
+        try:
+            return self.color_table[get_border_color_index(win, 0)][focused]
+        except IndexError: #unknown label
+            return self._fallback[0]
 
-        ret = self.colors.get(color)
-        if ret:
-            index = 0
-            if win.has_focus:
-                index = 1
-            return ret[index]
+class QubesMatch(Match):
+    ''' Match windows by their VM name and/or label, e.g. `QubesMatch(vm={'chat', 'mail'}, label='red')`.
+        The xprops are read from the cache and the results of all QubesMatch objects are kept in a single lookup table,
+        i.e. comparing a window against any number of QubesMatch objects costs a single dict lookup in general.
+    '''
 
-        return self.fallback
+    _instances = weakref.WeakSet()
+    _table = {} #(VM name, label index) --> frozenset of the matching QubesMatch objects
+
+    def __init__(self, vm=None, label=None):
+        '''
+        :param vm: VM name or set of VM names. 'dom0' matches dom0 windows. None matches all VMs.
+        :param label: Label name (e.g. 'red') or index or a set of these. None matches all labels.
+        '''
+        Match.__init__(self)
+        if vm is None and label is None:
+            raise ConfigError("QubesMatch requires a VM or label.")
+        self.vms = self._to_set(vm)
+        labels = self._to_set(label)
+        self.labels = None if labels is None else frozenset(self._to_label_index(l) for l in labels)
+
+        QubesMatch._instances.add(self)
+        QubesMatch._table = {}
+
+    @staticmethod
+    def _to_set(value):
+        if value is None:
+            return None
+        if isinstance(value, (str, int)):
+            return frozenset([value])
+        return frozenset(value)
+
+    @staticmethod
+    def _to_label_index(label):
+        if isinstance(label, int):
+            return label
+        for ind, name in QUBES_IND2LABEL.items():
+            if name == label:
+                return ind
+        raise ConfigError(f"Unknown label: {label}")
+
+    def _matches(self, vm, label):
+        return (self.vms is None or vm in self.vms) and (self.labels is None or label in self.labels)
+
+    def compare(self, client):
+        key = (get_vm_name(client) or 'dom0', get_border_color_index(client, 0))
+        try:
+            matches = QubesMatch._table[key]
+        except KeyError: #first window of that VM & label
+            matches = frozenset(m for m in QubesMatch._instances if m._matches(*key))
+            QubesMatch._table[key] = matches
+        return self in matches
+
+    def __repr__(self):
+        return f"<QubesMatch(vm={self.vms!r}, label={self.labels!r})>"
 
 class QubesTaskList(TaskList):
     ''' Use this class as task list on Qubes OS to prefix window names with the VM names.
     '''
 
+    defaults = [
+        ("incremental", True, "Only redraw the task boxes that changed since the last draw."),
+    ]
+
+    #maximum number of measured task name widths to keep
+    width_cache_size = 512
+
     def __init__(self, **config):
         TaskList.__init__(self, **config)
+        self.add_defaults(QubesTaskList.defaults)
+        _init_cache()
         self.cond_border = None
         if isinstance(self.border, ConditionalBorder):
             self.cond_border = self.border
+        self._taskname_cache = {} #window ID --> (key, task name)
+        self._width_cache = {} #task name --> box width
+        self._drawn = None #(layout, boxes) of the last draw
+        self._box_widths = None #(key, result) of the last calc_box_widths()
+        self._draw_queued = False
+
+    def _configure(self, qtile, bar):
+        TaskList._configure(self, qtile, bar)
+        #fonts or the drawer may have changed
+        self._width_cache.clear()
+        self._drawn = None
+        self._box_widths = None
+
+    def setup_hooks(self):
+        TaskList.setup_hooks(self)
+        hook.subscribe.client_killed(self._forget_window)
+
+    def _forget_window(self, window):
+        self._taskname_cache.pop(window.wid, None)
 
     #override to put the VM name in front of the window title
+    @profiled
     def get_taskname(self, window):
-        ret = TaskList.get_taskname(self, window)
         vm = get_vm_name(window)
         if not vm:
             vm = "dom0"
-        return f'[{vm}] {ret}'
+
+        #everything TaskList.get_taskname() depends on
+        location = window.group.windows.index(window) if self.window_name_location else None
+        key = (window.name, vm, window.minimized, window.maximized, window.floating, window is window.group.current_window, location)
+        cached = self._taskname_cache.get(window.wid)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        ret = f'[{vm}] {TaskList.get_taskname(self, window)}'
+        self._taskname_cache[window.wid] = (key, ret)
+        return ret
+
+    #override to avoid measuring the same text layout again
+    def box_width(self, text):
+        try:
+            return self._width_cache[text]
+        except KeyError:
+            pass
+        if len(self._width_cache) >= self.width_cache_size:
+            self._width_cache.clear()
+        width = TaskList.box_width(self, text)
+        self._width_cache[text] = width
+        return width
+
+    #override to filter the windows by their cached WindowSnapshot instead of 2 X server round-trips per window
+    @property
+    def windows(self):
+        windows = self.bar.screen.group.windows
+        if self.qtile.core.name != 'x11':
+            return windows
+        ret = []
+        for window in windows:
+            snapshot = get_snapshot(window)
+            if snapshot.wm_type in ('normal', None) and not snapshot.skip_taskbar:
+                ret.append(window)
+        return ret
+
+    #override to keep the box widths between draws: bar.draw() calls it once from calculate_length() & once from draw()
+    def calc_box_widths(self):
+        windows = self.windows
+        icons = tuple(self.get_window_icon(w) for w in windows) if self.icon_size else None
+        key = (self.max_width, tuple(windows), tuple(self.get_taskname(w) for w in windows), icons)
+        if self._box_widths and self._box_widths[0] == key:
+            return self._box_widths[1]
+        ret = list(TaskList.calc_box_widths(self))
+        self._box_widths = (key, ret)
+        return ret
 
     def get_active_window(self):
         ''' Get the currently active window. '''
-        #self.windows contains the list of windows of the currently active group
-        for win in self.windows:
-            return win.group.current_window
-        return None
+        group = self.bar.screen.group #None during screen configuration
+        return group.current_window if group else None
 
-    #override to support border colors for focused windows
-    def draw(self):
+    def get_border(self, window, focused):
+        ''' Get the border color of the task box of a window.
+        :param focused: Whether the window is the current window of its group.
+        :return: Border color or None for no border.
+        '''
+        if isinstance(self.cond_border, QubesBorder):
+            return self.cond_border.get_color(window, focused)
+        if not focused:
+            return self.unfocused_border or None
         if self.cond_border:
-            active = self.get_active_window()
-            self.border = self.cond_border.compare(active)
-        #NOTE: this hack cannot work for unfocused windows as there are many unfocused windows, but just one border_unfocused property
-        TaskList.draw(self)
+            return self.cond_border.compare(window)
+        return self.border
+
+    def _get_box_colors(self, window, active):
+        ''' Get the border and text color of a task box the same way TaskList.draw() does, but with per-window borders.
+            The border colors are looked up at draw time from the property cache, i.e. label changes are shown on the next draw.
+        :param active: The currently active window.
+        :return: Tuple (border color, text color).
+        '''
+        if window.urgent:
+            border = self.urgent_border
+            text_color = border
+        elif window is active:
+            border = self.get_border(window, True)
+            text_color = border
+        else:
+            border = self.get_border(window, False)
+            text_color = self.foreground
+
+        if self.highlight_method == "text":
+            border = None
+        else:
+            text_color = self.foreground
+        return border, text_color
+
+    def _clear_box(self, offset, width, background):
+        import cairocffi
+        ctx = self.drawer.ctx
+        ctx.save()
+        ctx.set_operator(cairocffi.OPERATOR_SOURCE)
+        self.drawer.set_source_rgb(background)
+        ctx.rectangle(offset, 0, width, self.widget_height)
+        ctx.fill()
+        ctx.restore()
+
+    #override to support per-window border colors & to only draw the task boxes that changed since the last draw
+    @profiled
+    def draw(self):
+        ''' Draw the task boxes. In incremental mode only the boxes that changed since the last draw are drawn.
+            The drawer pixmap keeps the unchanged boxes and the whole widget area is copied to the bar, i.e. exposures are
+            handled as well.
+        '''
+        boxes = []
+        offset = self.margin_side
+        active = self.get_active_window()
+        for win, icon, task, width in self.calc_box_widths():
+            border, text_color = self._get_box_colors(win, active)
+            boxes.append((offset, width, task, border, text_color, icon))
+            offset += width + self.spacing
+
+        background = self.background or self.bar.background
+        layout = (self.drawer, self.length, background, [box[:2] for box in boxes])
+        #NOTE: a widget hidden by a WidgetBox is removed from the bar & its disabled drawer doesn't update its pixmap,
+        #      mirrors need full redraws
+        incremental = self.incremental and not self.drawer.has_mirrors and self in self.bar.widgets
+        self.drawer.ctx.save()
+        if incremental and self._drawn and self._drawn[0] == layout:
+            self.rotate_drawer()
+            changed = [box for box, old in zip(boxes, self._drawn[1]) if box != old]
+            for offset, width, *_ in changed:
+                self._clear_box(offset, width, background)
+        else:
+            self.drawer.clear(background)
+            self.rotate_drawer()
+            changed = boxes
+
+        for offset, width, task, border, text_color, icon in changed:
+            textwidth = width - 2 * self.padding_side - ((self.icon_size + self.padding_side) if icon else 0)
+            self.drawbox(
+                offset,
+                task,
+                border,
+                text_color,
+                rounded=self.rounded,
+                block=(self.highlight_method == "block"),
+                width=textwidth,
+                icon=icon,
+            )
+
+        self.drawer.ctx.restore()
+        self._box_end_positions = [offset + width for offset, width, *_ in boxes]
+        self._drawn = (layout, boxes) if incremental else None
+        self.draw_at_default_position()
+
+    #override to only redraw this widget instead of the whole bar
+    def update(self, window=None):
+        if window and window.group is not self.bar.screen.group:
+            return
+        if self.length_type != bar.STRETCH: #the widget length depends on the task names
+            self.bar.draw()
+        elif not self._draw_queued:
+            #coalesce all updates within one event loop iteration
+            self._draw_queued = True
+            self.timeout_add(0, self._queued_draw)
+
+    def _queued_draw(self):
+        self._draw_queued = False
+        self.draw()
+
+def parse_wpctl_state(out):
+    ''' Parse the output of `qubes-wpctl printDefault`.
+    :return: Tuple (volume in percent or -1, if it couldn't be parsed, mute status).
+    '''
+    for line in out.splitlines():
+        if line.startswith('Out: '):
+            match = re.search(r'\[vol: ([0-9]+\.[0-9]+)', line)
+            volume = round(float(match.group(1)) * 100) if match else -1
+            return volume, 'MUTED' in line
+    return -1, False
+
+class QubesVolume(Volume):
+    ''' Volume widget for the audio VM. Non-dom0 audio VMs require qubes-wpctl (https://github.com/3hhh/qubes-terminal-hotkeys/tree/master/util)
+        & blib (https://github.com/3hhh/blib) in dom0.
+        Volume and mute status are read with a single asynchronous qubes-wpctl call per update. Volume changes are displayed
+        immediately and rapid changes (e.g. from a held volume key) are applied with a single qubes-wpctl call.
+        The *_command options of the Volume widget are only used for a dom0 audio VM.
+        The audio VM can be changed at runtime with set_audiovm(), i.e. without a config reload.
+    '''
+
+    defaults = [
+        ("audiovm", None, "Audio VM. dom0 is controlled like the Volume widget does (amixer or the *_command options), other VMs via qubes-wpctl. Can be changed at runtime with set_audiovm()."),
+        ("wpctl", "qubes-wpctl", "qubes-wpctl executable."),
+        ("step", 5, "Volume change for up and down commands in percent."),
+        ("limit_max_volume", True, "Limit the maximum volume to 100% for up commands."),
+        ("coalesce_delay", 0.3, "Time in seconds to wait for further volume changes before applying them."),
+        ("update_interval", 30, "Update time in seconds."),
+        ("volume_app", "qubes-wpctl app", "App to control volume"),
+    ]
+
+    def __init__(self, **config):
+        Volume.__init__(self, **config)
+        self.add_defaults(QubesVolume.defaults)
+        self._pending = 0 #volume change in percent that wasn't applied yet
+        self._apply_timer = None
+        self._applying = False
+        self._busy = 0 #number of running qubes-wpctl calls changing the state
+
+    def timer_setup(self):
+        if self.theme_path:
+            self.setup_images()
+        self.timeout_add(0, self.update)
+
+    def _is_dom0(self):
+        return self.audiovm == 'dom0'
+
+    async def _run(self, cmd):
+        ''' Run a command.
+        :param cmd: List of arguments or a shell command string.
+        :return: Its output or None on errors.
+        '''
+        try:
+            if isinstance(cmd, str):
+                proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            else:
+                proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            out, _ = await proc.communicate()
+        except OSError:
+            logger.exception('Failed to execute %s.', cmd)
+            return None
+        #NOTE: qtile reaps all child processes on SIGCHLD, i.e. proc.returncode is unreliable
+        return out.decode()
+
+    async def _wpctl(self, *args):
+        ''' Run qubes-wpctl.
+        :return: Its output or None on errors.
+        '''
+        return await self._run([self.wpctl, *args])
+
+    async def _read_state(self):
+        ''' Read the volume and mute status of the current audio VM.
+        :return: Tuple (volume in percent or -1, mute status) or None on errors.
+        '''
+        if self._is_dom0():
+            #Volume.get_volume() blocks on amixer or the *_command options
+            return await self.qtile.run_in_executor(self.get_volume)
+        out = await self._wpctl('printDefault')
+        return None if out is None else parse_wpctl_state(out)
+
+    async def _apply_delta(self, delta):
+        ''' Change the volume of the current audio VM by the given percentage. '''
+        sign = "+" if delta > 0 else "-"
+        if not self._is_dom0():
+            await self._wpctl('volumeOut', f'{abs(delta)}%{sign}')
+            return
+        cmd = self.volume_up_command if delta > 0 else self.volume_down_command
+        if cmd is None:
+            await self._run(self.create_amixer_command('-q', 'sset', self.channel, f'{abs(delta)}%{sign}'))
+            return
+        for _ in range(max(abs(delta) // self.step, 1)): #the commands change the volume by a single step
+            await self._run(cmd)
+
+    def _set_state(self, volume, muted):
+        if volume != self.volume or muted != self.is_mute:
+            self.volume = volume
+            self.is_mute = muted
+            self._update_drawer()
+            self.bar.draw()
+
+    async def refresh(self):
+        ''' Read the current volume and mute status. Pending changes take precedence. '''
+        if self._pending or self._busy:
+            return
+        audiovm = self.audiovm
+        state = await self._read_state()
+        if state is not None and not self._pending and not self._busy and audiovm == self.audiovm:
+            self._set_state(*state)
+
+    async def update(self):
+        await self.refresh()
+        self.timeout_add(self.update_interval, self.update)
+
+    def _change_volume(self, delta):
+        if self.volume is not None and self.volume >= 0:
+            #NOTE: the displayed volume includes the pending changes
+            target = max(self.volume + delta, 0)
+            if self.limit_max_volume:
+                target = min(target, max(self.volume, 100))
+            delta = target - self.volume
+            if not delta:
+                return
+            self._set_state(target, self.is_mute)
+        self._pending += delta
+        if self._apply_timer:
+            self._apply_timer.cancel()
+        self._apply_timer = self.timeout_add(self.coalesce_delay, self._apply_volume)
+
+    async def _apply_volume(self):
+        self._apply_timer = None
+        if self._applying: #the running call applies all pending changes
+            return
+        self._applying = True
+        self._busy += 1
+        try:
+            while self._pending:
+                delta = self._pending
+                self._pending = 0
+                await self._apply_delta(delta)
+        finally:
+            self._applying = False
+            self._busy -= 1
+        await self.refresh()
+
+    @expose_command()
+    def increase_vol(self):
+        self._change_volume(self.step)
+
+    @expose_command()
+    def decrease_vol(self):
+        self._change_volume(-self.step)
+
+    @expose_command()
+    def mute(self):
+        if self.volume is not None:
+            self._set_state(self.volume, not self.is_mute)
+        create_task(self._toggle_mute())
+
+    async def _toggle_mute(self):
+        self._busy += 1
+        try:
+            if self._is_dom0():
+                await self._run(self.mute_command or self.create_amixer_command('-q', 'sset', self.channel, 'toggle'))
+            else:
+                await self._wpctl('toggle', 'default')
+        finally:
+            self._busy -= 1
+        await self.refresh()
+
+    @expose_command()
+    def set_audiovm(self, audiovm):
+        ''' Change the audio VM to control, e.g. after the default_audiovm Qubes preference changed. '''
+        if audiovm == self.audiovm:
+            return
+        self.audiovm = audiovm
+        self._pending = 0
+        if self._apply_timer:
+            self._apply_timer.cancel()
+            self._apply_timer = None
+        create_task(self.refresh())
+
+# UPower
+UPOWER_SERVICE = 'org.freedesktop.UPower'
+UPOWER_DEVICE_INTERFACE = 'org.freedesktop.UPower.Device'
+UPOWER_DISPLAY_DEVICE = '/org/freedesktop/UPower/devices/DisplayDevice'
+
+# UPower device state --> qtile battery state
+UPOWER_STATES = {
+    0: BatteryState.UNKNOWN,
+    1: BatteryState.CHARGING,
+    2: BatteryState.DISCHARGING,
+    3: BatteryState.EMPTY,
+    4: BatteryState.FULL,
+    5: BatteryState.NOT_CHARGING, #pending charge
+    6: BatteryState.NOT_CHARGING, #pending discharge
+}
+
+class _UPowerBattery(_Battery):
+    ''' Battery backend returning the last known UPower device properties. '''
+
+    def __init__(self, properties):
+        '''
+        :param properties: UPower device properties as dict: name --> value.
+        '''
+        self.properties = properties
+
+    def update_status(self):
+        props = self.properties
+        state = UPOWER_STATES.get(props.get('State', 0), BatteryState.UNKNOWN)
+        if state == BatteryState.CHARGING:
+            remaining = props.get('TimeToFull', 0)
+        else:
+            remaining = props.get('TimeToEmpty', 0)
+        return BatteryStatus(state=state, percent=props.get('Percentage', 0) / 100, power=props.get('EnergyRate', 0),
+                             time=remaining, charge_start_threshold=props.get('ChargeStartThreshold', 0),
+                             charge_end_threshold=props.get('ChargeEndThreshold', 100))
+
+class QubesBattery(Battery):
+    ''' Battery widget, which is updated by UPower PropertiesChanged signals and redraws only if the battery status changed.
+        If UPower isn't available, the battery is polled via sysfs instead: in update_interval while charging,
+        less often while on AC and full and more often while discharging.
+        For testing, upower_bus='session' can be used to connect to a stand-in UPower service such as bench/fake_upower.py.
+    '''
+
+    defaults = [
+        ("upower", True, "Whether to use UPower. If False, sysfs is polled."),
+        ("upower_bus", "system", "D-Bus bus to find UPower on (system or session)."),
+        ("upower_device", UPOWER_DISPLAY_DEVICE, "D-Bus object path of the UPower device to display."),
+        ("discharging_interval", 30, "Polling interval in seconds while discharging (without UPower)."),
+        ("full_interval", 600, "Polling interval in seconds while on AC and not charging (without UPower)."),
+    ]
+
+    def __init__(self, **config):
+        Battery.__init__(self, **config)
+        self.add_defaults(QubesBattery.defaults)
+        self.charging_interval = self.update_interval
+        self._status = None #last displayed status
+        self._bus = None
+
+    def timer_setup(self):
+        if self.upower:
+            create_task(self._connect_upower())
+        else:
+            Battery.timer_setup(self)
+
+    async def _connect_upower(self):
+        ''' Read the UPower device properties and subscribe to their changes. Falls back to polling on errors. '''
+        try:
+            from dbus_fast import BusType, Message, MessageType
+            from dbus_fast.aio import MessageBus
+            bus_type = BusType.SESSION if self.upower_bus == 'session' else BusType.SYSTEM
+            self._bus = await MessageBus(bus_type=bus_type).connect()
+
+            rule = f"type='signal',interface='org.freedesktop.DBus.Properties',member='PropertiesChanged',path='{self.upower_device}',arg0='{UPOWER_DEVICE_INTERFACE}'"
+            reply = await self._bus.call(Message(destination='org.freedesktop.DBus', path='/org/freedesktop/DBus', interface='org.freedesktop.DBus',
+                                                 member='AddMatch', signature='s', body=[rule]))
+            if reply.message_type != MessageType.METHOD_RETURN:
+                raise RuntimeError(f'AddMatch failed: {reply.body}')
+            self._bus.add_message_handler(self._on_message)
+
+            #NOTE: subscribed before reading, so that no change is lost
+            reply = await self._bus.call(Message(destination=UPOWER_SERVICE, path=self.upower_device, interface='org.freedesktop.DBus.Properties',
+                                                 member='GetAll', signature='s', body=[UPOWER_DEVICE_INTERFACE]))
+            if reply.message_type != MessageType.METHOD_RETURN:
+                raise RuntimeError(reply.body[0] if reply.body else reply.error_name)
+        except Exception as e:
+            logger.info('UPower is unavailable (%s), polling the battery instead.', e)
+            self._disconnect()
+            Battery.timer_setup(self)
+            return
+
+        self._battery = _UPowerBattery({name: variant.value for name, variant in reply.body[0].items()})
+        self._refresh()
+
+    def _on_message(self, msg):
+        if msg.member != 'PropertiesChanged' or msg.path != self.upower_device or not msg.body or msg.body[0] != UPOWER_DEVICE_INTERFACE:
+            return
+        props = self._battery.properties
+        for name, variant in msg.body[1].items():
+            props[name] = variant.value
+        for name in msg.body[2]:
+            props.pop(name, None)
+        self._refresh()
+
+    def _refresh(self):
+        if self.finalized:
+            return
+        status = self._battery.update_status()
+        if status != self._status:
+            self.update(self.poll())
+
+    def build_string(self, status):
+        self._status = status
+        if not self._bus:
+            #adaptive polling
+            if status.state == BatteryState.DISCHARGING:
+                self.update_interval = self.discharging_interval
+            elif status.state in (BatteryState.FULL, BatteryState.NOT_CHARGING):
+                self.update_interval = self.full_interval
+            else:
+                self.update_interval = self.charging_interval
+        return Battery.build_string(self, status)
+
+    def _disconnect(self):
+        if self._bus:
+            try:
+                self._bus.disconnect()
+            except OSError:
+                pass
+            self._bus = None
+
+    def finalize(self):
+        self._disconnect()
+        Battery.finalize(self)
+
+class DeferredWidget(base._Widget):
+    ''' Placeholder for a widget, which is constructed and configured only after the bar was drawn for the first time.
+        This makes the bar appear sooner on startup. Use it for widgets that are slow to import or construct, e.g.
+        `DeferredWidget(lambda: widget.Battery())`. Deferred widgets cannot be mirrored to other bars.
+    '''
+
+    def __init__(self, factory, **config):
+        '''
+        :param factory: Function without arguments to create the widget.
+        '''
+        base._Widget.__init__(self, 0, **config)
+        self.factory = factory
+
+    def timer_setup(self):
+        #NOTE: the first bar draw was already queued
+        self.qtile.call_soon(self._replace)
+
+    def _replace(self):
+        bar = self.bar
+        if self.finalized or self not in bar.widgets:
+            return
+
+        try:
+            with startup_timer('widget', self.name):
+                widget = self.factory()
+        except Exception:
+            logger.exception('Failed to create the deferred widget %s.', self.name)
+            return
+
+        bar.widgets[bar.widgets.index(self)] = widget
+        for name, w in list(self.qtile.widgets_map.items()):
+            if w is self:
+                del self.qtile.widgets_map[name]
+        self.finalize()
+
+        if bar._configure_widget(widget):
+            self.qtile.register_widget(widget)
+        else:
+            bar._remove_crashed_widgets({widget})
+        bar.draw()
+
+    def draw(self):
+        pass
+
+class QubesBar(bar.Bar):
+    ''' Bar, which only repaints the widgets that changed.
+        All draw requests of an event loop iteration, both of the bar and of its widgets, are coalesced into a single paint.
+        That paint only redraws the widgets that requested it or whose position or size changed. As every widget copies
+        its own area to the bar window, only these areas are updated.
+        Widgets request a repaint by calling their draw() method, e.g. qtile's text widgets do so, if their text changed, but
+        not their width (the clock every second). Calls to draw() of the bar (e.g. widgets that changed their width, expose
+        events) repaint the whole bar.
+    '''
+
+    def __init__(self, widgets, size, **config):
+        bar.Bar.__init__(self, widgets, size, **config)
+        self._dirty = set() #widgets to repaint
+        self._dirty_all = True
+        self._painting = False
+        self._geometry = {} #widget --> (offsetx, offsety, length) at its last paint
+        self._end = None #end of the last widget at the last paint
+
+    def _configure_widget(self, widget):
+        ret = bar.Bar._configure_widget(self, widget)
+        if ret and not hasattr(widget.draw, 'paint'):
+            paint = widget.draw
+
+            def request_draw():
+                if self._painting:
+                    paint()
+                else:
+                    self.widget_changed(widget)
+
+            request_draw.paint = paint
+            widget.draw = request_draw
+        return ret
+
+    def _queue_draw(self):
+        if not self._draw_queued and self.widgets:
+            self.future = self.qtile.call_soon(self._actual_draw)
+            self._draw_queued = True
+
+    def widget_changed(self, widget):
+        ''' Request a repaint of a single widget, e.g. because its content changed. Widgets moved by a size change of that
+            widget are repainted as well.
+        '''
+        if widget in self._geometry:
+            self._dirty.add(widget)
+        else:
+            self._dirty_all = True
+        self._queue_draw()
+
+    def draw(self):
+        self._dirty_all = True
+        self._queue_draw()
+
+    def _paint_widget(self, widget):
+        draw = widget.draw
+        getattr(draw, 'paint', draw)() #mirrored widgets replace their draw method
+        self._geometry[widget] = (widget.offsetx, widget.offsety, widget.length)
+
+    @profiled
+    def _actual_draw(self):
+        self._draw_queued = False
+        dirty = self._dirty
+        self._dirty = set()
+        if not self._dirty_all:
+            self._resize(self._length, self.widgets)
+            last = self.widgets[-1]
+            end = last.offsetx + last.length if self.horizontal else last.offsety + last.length
+            #the unoccupied space after the last widget must be cleared
+            self._dirty_all = end != self._end
+
+        if self._dirty_all:
+            self._dirty_all = False
+            self._painting = True
+            try:
+                bar.Bar._actual_draw(self)
+            finally:
+                self._painting = False
+            self._geometry = {w: (w.offsetx, w.offsety, w.length) for w in self.widgets}
+            last = self.widgets[-1]
+            self._end = last.offsetx + last.length if self.horizontal else last.offsety + last.length
+            return
+
+        for widget in self.widgets:
+            if widget in dirty or self._geometry.get(widget) != (widget.offsetx, widget.offsety, widget.length):
+                self._paint_widget(widget)
+
+# calendar
+# width of a month in `cal -wm` in characters
+CAL_WIDTH = 23
+
+# separator between two months
+CAL_SEPARATOR = '   '
+
+@functools.lru_cache(maxsize=128)
+def month_grid(year, month):
+    ''' Month grid as displayed by `cal -wm` (weeks start on Monday).
+    :return: Tuple of weeks as tuples (ISO week number, tuple of 7 days of the month or 0 for days of other months).
+    '''
+    weeks = []
+    for days in calendar.Calendar(firstweekday=0).monthdayscalendar(year, month):
+        first = next(day for day in days if day)
+        weeks.append((datetime.date(year, month, first).isocalendar()[1], tuple(days)))
+    return tuple(weeks)
+
+@functools.lru_cache(maxsize=128)
+def month_lines(year, month, highlight=0, highlight_format='{}'):
+    ''' Lines of a month as displayed by `cal -wm` in pango markup. All lines are CAL_WIDTH characters wide.
+    :param highlight: Day of the month to highlight (0: none).
+    :param highlight_format: Format string for the highlighted day.
+    :return: Tuple of 8 lines.
+    '''
+    lines = [f'{calendar.month_name[month]} {year}'.center(CAL_WIDTH), '   ' + ' '.join(calendar.day_abbr[i][:2] for i in range(7))]
+    for week, days in month_grid(year, month):
+        cells = []
+        for day in days:
+            cell = f'{day:2d}' if day else '  '
+            cells.append(highlight_format.format(cell) if day and day == highlight else cell)
+        lines.append(f'{week:2d} ' + ' '.join(cells))
+    lines.extend([' ' * CAL_WIDTH] * (8 - len(lines))) #constant height, like cal
+    return tuple(lines)
+
+def add_months(year, month, delta):
+    ''' Add delta months to the given month.
+    :return: Tuple (year, month).
+    '''
+    ind = year * 12 + month - 1 + delta
+    return ind // 12, ind % 12 + 1
+
+@functools.lru_cache(maxsize=32)
+def render_months(year, month, count, columns, highlight=None, highlight_format='{}'):
+    ''' Render count months starting from the given one side by side as pango markup.
+    :param highlight: Date to highlight as tuple (year, month, day) or None.
+    '''
+    blocks = []
+    for i in range(count):
+        y, m = add_months(year, month, i)
+        day = highlight[2] if highlight and highlight[:2] == (y, m) else 0
+        blocks.append(month_lines(y, m, day, highlight_format))
+
+    rows = []
+    for i in range(0, count, columns):
+        rows.extend(CAL_SEPARATOR.join(parts) for parts in zip(*blocks[i:i + columns]))
+    return '\n'.join(row.rstrip() for row in rows)
+
+def _parse_month(arg):
+    if arg.isdigit():
+        month = int(arg)
+    else:
+        names = [name.lower() for name in calendar.month_name]
+        abbrs = [name.lower() for name in calendar.month_abbr]
+        arg = arg.lower()
+        month = names.index(arg) if arg in names else abbrs.index(arg) if arg in abbrs else 0
+    if not 1 <= month <= 12:
+        raise ValueError(f'Invalid month: {arg}')
+    return month
+
+def parse_cal_args(line, today=None):
+    ''' Parse the arguments of `cal` as used by util/ical: [-1|-3|-y|-n N|--months N] [[[day] month] year]
+        The month may also be given by its name.
+    :param today: datetime.date to use as today.
+    :return: Tuple (year, month, number of months, date to highlight as tuple (year, month, day)).
+    :raise ValueError: for invalid arguments.
+    '''
+    today = today or datetime.date.today()
+    count = 1
+    centered = False #-3 shows the previous & next month as well
+    whole_year = False
+    positional = []
+    args = line.split()
+    while args:
+        arg = args.pop(0)
+        if arg in ('-1', '--one'):
+            count = 1
+            centered = False
+        elif arg in ('-3', '--three'):
+            count = 3
+            centered = True
+        elif arg in ('-y', '--year'):
+            whole_year = True
+        elif arg in ('-Y', '--twelve'):
+            count = 12
+            centered = False
+        elif arg == '--months' or arg.startswith('--months=') or arg.startswith('-n'):
+            if arg == '--months':
+                value = args.pop(0) if args else ''
+            elif arg.startswith('--months='):
+                value = arg[len('--months='):]
+            else: #-nN or -n N
+                value = arg[2:] or (args.pop(0) if args else '')
+            if not value.isdigit() or not 1 <= int(value) <= 120:
+                raise ValueError(f'Invalid number of months: {value}')
+            count = int(value)
+            centered = False
+        elif arg in ('-w', '-m', '-wm', '-mw', '--week', '--monday'):
+            pass #always used
+        elif arg.startswith('-'):
+            raise ValueError(f'Unsupported option: {arg}')
+        else:
+            positional.append(arg)
+
+    if len(positional) > 3:
+        raise ValueError('Too many arguments.')
+    year, month, day = today.year, today.month, today.day
+    highlight = (year, month, day)
+    if len(positional) == 1 and not positional[0].isdigit():
+        month = _parse_month(positional[0])
+    elif positional:
+        if not positional[-1].isdigit() or not 1 <= int(positional[-1]) <= 9999:
+            raise ValueError(f'Invalid year: {positional[-1]}')
+        year = int(positional[-1])
+        if len(positional) == 1: #cal displays the whole year
+            whole_year = True
+        else:
+            month = _parse_month(positional[-2])
+        if len(positional) == 3:
+            if not positional[0].isdigit() or not 1 <= int(positional[0]) <= calendar.monthrange(year, month)[1]:
+                raise ValueError(f'Invalid day: {positional[0]}')
+            day = int(positional[0])
+            highlight = (year, month, day)
+
+    if whole_year:
+        return year, 1, 12, highlight
+    if centered:
+        year, month = add_months(year, month, -1)
+    return year, month, count, highlight
+
+class QubesCalendar(configurable.Configurable):
+    ''' Calendar popup in the style of `cal -wm`, which replaces a terminal running util/ical.
+        Rendered months are cached and the neighbouring months are rendered in advance, i.e. it appears and switches months
+        within milliseconds.
+        Left/Right switch to the previous/next month, Up/Down to the previous/next year and Home to today.
+        Typing `cal` arguments such as `-3`, `-y`, `2027` or `24 12 2026` and Return displays these dates.
+        Escape or a click close the calendar.
+    '''
+
+    defaults = [
+        ("font", "monospace", "Font (must be monospaced)."),
+        ("fontsize", 14, "Font size."),
+        ("foreground", "#ffffff", "Text colour."),
+        ("background", "#111111", "Background colour."),
+        ("highlight_foreground", "#000000", "Text colour of the highlighted day."),
+        ("highlight_background", "#ffffff", "Background colour of the highlighted day."),
+        ("border", "#ffffff", "Border colour."),
+        ("border_width", 1, "Border width."),
+        ("padding", 8, "Padding around the text."),
+        ("columns", 3, "Maximum number of months per row."),
+        ("prompt", "cal prompt: ", "Prompt for `cal` arguments."),
+    ]
+
+    def __init__(self, **config):
+        configurable.Configurable.__init__(self, **config)
+        self.add_defaults(QubesCalendar.defaults)
+        self.highlight_format = f'<span foreground="{self.highlight_foreground}" background="{self.highlight_background}">{{}}</span>'
+        self.popup = None
+        self.visible = False
+        self.keys = {}
+        self._view = None #(year, month, number of months, date to highlight)
+        self._input = ''
+        self._error = None
+
+    def _create_popup(self):
+        from libqtile.popup import Popup
+        self.popup = Popup(qtile, font=self.font, fontsize=self.fontsize, foreground=self.foreground, background=self.background,
+                           border=self.border, border_width=self.border_width, horizontal_padding=self.padding,
+                           vertical_padding=self.padding, wrap=False)
+        self.popup.win.process_key_press = self.process_key_press
+        self.popup.win.process_button_click = self.process_button_click
+        if self.keys:
+            return
+        keys = {
+            'Left': lambda: self.move(-1),
+            'Right': lambda: self.move(1),
+            'Up': lambda: self.move(-12),
+            'Down': lambda: self.move(12),
+            'Home': self.today,
+            'Escape': self.hide,
+            'Return': self.apply_input,
+            'KP_Enter': self.apply_input,
+            'BackSpace': lambda: self.edit(self._input[:-1]),
+        }
+        self.keys = {qtile.core.keysym_from_name(key): func for key, func in keys.items()}
+
+    def show(self, args=''):
+        ''' Show the calendar.
+        :param args: `cal` arguments to display.
+        '''
+        if self.visible:
+            self.hide(restore_focus=False)
+        self._create_popup()
+        self._input = ''
+        self._view = parse_cal_args('')
+        self._set_view(args)
+        self._draw(place=True)
+        self.popup.unhide()
+        self.popup.win.focus(False)
+        hook.subscribe.client_focus(self._focus_change)
+        hook.subscribe.focus_change(self._focus_change)
+        self.visible = True
+
+    def hide(self, restore_focus=True):
+        ''' Hide the calendar.
+        :param restore_focus: Whether to focus the previously focused window again.
+        '''
+        if not self.visible:
+            return
+        self.visible = False
+        hook.unsubscribe.client_focus(self._focus_change)
+        hook.unsubscribe.focus_change(self._focus_change)
+        #NOTE: the window is re-created on the next show() as the configuration may be reloaded in the meantime
+        self.popup.kill()
+        self.popup = None
+        if restore_focus and qtile.current_window:
+            qtile.current_window.focus(warp=False)
+
+    def toggle(self):
+        if self.visible:
+            self.hide()
+        else:
+            self.show()
+
+    def _focus_change(self, window=None):
+        if self.popup and window is not self.popup.win:
+            self.hide(restore_focus=False)
+
+    def _set_view(self, args):
+        try:
+            self._view = parse_cal_args(args)
+            self._error = None
+        except ValueError as e:
+            self._error = str(e)
+
+    def move(self, delta):
+        year, month, count, highlight = self._view
+        year, month = add_months(year, month, delta)
+        self._view = (year, month, count, highlight)
+        self._error = None
+        self._draw()
+
+    def today(self):
+        self._set_view('')
+        self._draw()
+
+    def edit(self, text):
+        self._input = text
+        self._draw()
+
+    def apply_input(self):
+        self._set_view(self._input)
+        self._input = ''
+        self._draw(place=True)
+
+    def process_key_press(self, keysym):
+        func = self.keys.get(keysym)
+        if func:
+            func()
+        elif keysym < 127 and chr(keysym).isprintable():
+            self.edit(self._input + chr(keysym))
+
+    def process_button_click(self, x, y, button):
+        if button == 4:
+            self.move(-1)
+        elif button == 5:
+            self.move(1)
+        else:
+            self.hide()
+
+    def render(self):
+        ''' Render the current view as pango markup. '''
+        year, month, count, highlight = self._view
+        text = render_months(year, month, count, min(count, self.columns), highlight, self.highlight_format)
+        text += f'\n\n{html.escape(self.prompt)}{html.escape(self._input)}_'
+        if self._error:
+            text += f'\n{html.escape(self._error)}'
+        return text
+
+    def _prefetch(self):
+        ''' Render the neighbouring months, so that navigating to them is instant. '''
+        if not self.visible or not self._view:
+            return
+        year, month, count, highlight = self._view
+        for delta in (-1, 1):
+            y, m = add_months(year, month, delta)
+            render_months(y, m, count, min(count, self.columns), highlight, self.highlight_format)
+
+    def _draw(self, place=False):
+        popup = self.popup
+        popup.layout.text = self.render()
+        width = popup.layout.width + 2 * self.padding
+        height = popup.layout.height + 2 * self.padding
+        if place or width > popup.width or height > popup.height:
+            popup.width = width
+            popup.height = height
+            self._place()
+        popup.clear()
+        popup.draw_text()
+        popup.draw()
+        qtile.call_soon(self._prefetch)
+
+    def _place(self):
+        ''' Place the popup below the mouse pointer (i.e. the clock that was clicked) and inside the current screen. '''
+        popup = self.popup
+        screen = qtile.current_screen
+        try:
+            x, _ = qtile.core.get_mouse_position()
+        except NotImplementedError:
+            x = screen.x + screen.width
+        popup.x = max(screen.x, min(x - popup.width // 2, screen.x + screen.width - popup.width - 2 * self.border_width))
+        popup.y = screen.y + (screen.top.size if screen.top else 0)
+        popup.place()
+
+# backlight
+BACKLIGHT_DIR = '/sys/class/backlight'
+
+# preferred backlight device types (as systemd-backlight)
+BACKLIGHT_TYPES = ['firmware', 'platform', 'raw']
+
+# time in seconds after which the brightness is read from sysfs again (it may have been changed by other programs)
+BACKLIGHT_REFRESH = 5
+
+class Backlight:
+    ''' Backlight controller. The device is discovered once and the brightness is kept in memory.
+        Changes are coalesced, i.e. a held key results in at most one brightness change per frame (delay) and never in
+        brightness changes applied out of order. Brightness changes are written to sysfs or, if that's not writable,
+        set via logind.
+    '''
+
+    def __init__(self, device=None, minimum=1, delay=1/60):
+        '''
+        :param device: Name of the device in /sys/class/backlight/. Default: auto-detect.
+        :param minimum: Minimum brightness value to set.
+        :param delay: Minimum time in seconds between two brightness changes.
+        '''
+        self.device = device
+        self.minimum = minimum
+        self.delay = delay
+        self.path = None
+        self.max = None
+        self.value = None #brightness value that was last applied or read
+        self.target = None #brightness value to apply
+        self.writable = False
+        self.listeners = [] #functions to call with the brightness in percent on changes
+        self._discovered = False
+        self._timer = None
+        self._applying = False
+        self._last_change = 0
+        self._bus = None
+
+    def _read(self, name):
+        with open(os.path.join(self.path, name)) as f:
+            return int(f.read())
+
+    def _discover(self):
+        ''' Find the backlight device once.
+        :return: Whether a device is available.
+        '''
+        if self._discovered:
+            return self.path is not None
+        self._discovered = True
+
+        try:
+            devices = sorted(os.listdir(BACKLIGHT_DIR))
+        except OSError:
+            devices = []
+        if self.device is None:
+            def rank(device):
+                try:
+                    with open(os.path.join(BACKLIGHT_DIR, device, 'type')) as f:
+                        return BACKLIGHT_TYPES.index(f.read().strip())
+                except (OSError, ValueError):
+                    return len(BACKLIGHT_TYPES)
+            self.device = min(devices, key=rank, default=None)
+        if self.device not in devices:
+            logger.warning('No backlight device found in %s.', BACKLIGHT_DIR)
+            return False
+
+        self.path = os.path.join(BACKLIGHT_DIR, self.device)
+        try:
+            self.max = self._read('max_brightness')
+            self.value = self.target = self._read('brightness')
+        except (OSError, ValueError):
+            logger.exception('Failed to read the backlight device %s.', self.path)
+            self.path = None
+            return False
+        self.writable = os.access(os.path.join(self.path, 'brightness'), os.W_OK)
+        return True
+
+    @property
+    def percent(self):
+        ''' Brightness to be displayed in percent or None, if there's no backlight device. '''
+        if self.target is None or not self.max:
+            return None
+        return round(100 * self.target / self.max)
+
+    def change(self, percent):
+        ''' Change the brightness.
+        :param percent: Percent of the maximum brightness to add (may be negative).
+        '''
+        if not self._discover():
+            return
+        now = time.monotonic()
+        if not self._applying and self._timer is None and now - self._last_change > BACKLIGHT_REFRESH:
+            with contextlib.suppress(OSError, ValueError):
+                self.value = self.target = self._read('brightness')
+        self._last_change = now
+        if percent:
+            #devices with few levels (e.g. 7 for some ACPI firmware) must change by at least one level
+            self.set_value(self.target + int(math.copysign(max(1, round(self.max * abs(percent) / 100)), percent)))
+
+    def set_value(self, value):
+        ''' Set the brightness to the given value (between 0 and the maximum brightness of the device). '''
+        if not self._discover():
+            return
+        value = max(self.minimum, min(value, self.max))
+        if value == self.target:
+            return
+        self.target = value
+        for listener in self.listeners:
+            listener(self.percent)
+        if self._timer is None and not self._applying:
+            self._timer = qtile.call_later(self.delay, self._start_apply)
+
+    def _start_apply(self):
+        self._timer = None
+        create_task(self._apply())
+
+    async def _apply(self):
+        self._applying = True
+        try:
+            while self.target != self.value:
+                value = self.target
+                if self.writable:
+                    await qtile.run_in_executor(self._write, value)
+                else:
+                    await self._set_logind(value)
+                self.value = value
+                if self.target != value:
+                    await asyncio.sleep(self.delay)
+        except Exception:
+            logger.exception('Failed to set the brightness of %s.', self.path)
+            self.target = self.value
+            for listener in self.listeners:
+                listener(self.percent)
+        finally:
+            self._applying = False
+
+    def _write(self, value):
+        with open(os.path.join(self.path, 'brightness'), 'w') as f:
+            f.write(str(value))
+
+    async def _set_logind(self, value):
+        from dbus_fast import BusType, Message, MessageType
+        from dbus_fast.aio import MessageBus
+        if self._bus is None:
+            self._bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+        reply = await self._bus.call(Message(destination='org.freedesktop.login1', path='/org/freedesktop/login1/session/auto',
+                                             interface='org.freedesktop.login1.Session', member='SetBrightness', signature='ssu',
+                                             body=['backlight', self.device, value]))
+        if reply.message_type != MessageType.METHOD_RETURN:
+            raise RuntimeError(f'SetBrightness failed: {reply.error_name} {reply.body}')
+
+backlight = Backlight()
+
+def change_brightness(qtile, percent):
+    ''' Change the screen brightness, e.g. via `lazy.function(change_brightness, 2)`.
+    :param percent: Percent of the maximum brightness to add (may be negative).
+    '''
+    backlight.change(percent)
+
+class QubesBacklight(base._TextBox):
+    ''' Brightness widget, which is updated by the Backlight controller, i.e. it doesn't poll sysfs. '''
+
+    defaults = [
+        ("format", "{percent}%", "Display format."),
+        ("step", 2, "Brightness change in percent for mouse wheel events."),
+        ("backlight", None, "Backlight controller. Default: The one used by change_brightness()."),
+    ]
+
+    def __init__(self, **config):
+        base._TextBox.__init__(self, '', **config)
+        self.add_defaults(QubesBacklight.defaults)
+        self.backlight = self.backlight or backlight
+        self.add_callbacks({
+            'Button4': lambda: self.backlight.change(self.step),
+            'Button5': lambda: self.backlight.change(-self.step),
+        })
+
+    def _configure(self, qtile, bar):
+        base._TextBox._configure(self, qtile, bar)
+        self.backlight.listeners.append(self._changed)
+        if self.backlight._discover():
+            self.text = self.format.format(percent=self.backlight.percent)
+
+    def _changed(self, percent):
+        self.update(self.format.format(percent=percent))
+
+    def finalize(self):
+        with contextlib.suppress(ValueError):
+            self.backlight.listeners.remove(self._changed)
+        base._TextBox.finalize(self)
+
+# screenshots
+SCREENSHOT_DIR = os.path.expanduser('~/screenshots')
+
+def _get_screenshot_region(qtile, target):
+    ''' Get the region to capture for a screenshot target in root window coordinates.
+    :return: Tuple (x, y, width, height) or None, if there's nothing to capture.
+    '''
+    if target == 'root':
+        root = qtile.core.conn.default_screen
+        return 0, 0, root.width_in_pixels, root.height_in_pixels
+    if target == 'screen':
+        screen = qtile.current_screen
+        return screen.x, screen.y, screen.width, screen.height
+    if target == 'window':
+        win = qtile.current_window
+        if win is None:
+            return None
+        border = win.borderwidth
+        return win.x, win.y, win.width + 2 * border, win.height + 2 * border
+    raise ValueError(f'Invalid screenshot target: {target}')
+
+def _write_screenshot(conn, sequence, width, height, path):
+    ''' Wait for a GetImage reply and write it as PNG file. Meant to be run in a worker thread (libxcb is thread-safe).
+        The image data is passed from the xcb reply buffer to cairo without copying.
+    '''
+    import cairocffi
+    from xcffib import ffi
+    reply = conn.wait_for_reply(sequence)
+    size = width * height * 4
+    if reply.known_max - 32 < size:
+        raise RuntimeError(f'Unsupported pixel format: Received {reply.known_max - 32} bytes for {width}x{height} pixels.')
+
+    #X11 replies have a 32 byte header, the ZPixmap data of 24/32 bit depths is in the cairo RGB24 format (BGRX on little-endian)
+    data = ffi.buffer(ffi.cast('char *', reply.cdata) + 32, size)
+    surface = cairocffi.ImageSurface.create_for_data(data, cairocffi.FORMAT_RGB24, width, height, width * 4)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        surface.write_to_png(tmp)
+        os.replace(tmp, path)
+    finally:
+        surface.finish()
+    return path
+
+def _screenshot_done(future):
+    try:
+        logger.info('Screenshot saved to %s.', future.result())
+    except Exception:
+        logger.exception('Failed to take a screenshot.')
+
+def take_screenshot(qtile, target='screen', region=None, directory=SCREENSHOT_DIR):
+    ''' Save a screenshot as PNG file, e.g. via `lazy.function(take_screenshot, 'window')`. X11 only.
+        The image is requested via qtile's X connection and encoded in a worker thread, i.e. the event loop isn't blocked.
+    :param target: What to capture: 'root' (all screens), 'screen' (the current screen) or 'window' (the focused window).
+    :param region: Tuple (x, y, width, height) in root window coordinates to capture instead of the target.
+    :param directory: Directory to save the screenshot to.
+    :return: Future of the path of the PNG file or None, if there was nothing to capture.
+    '''
+    if qtile.core.name != 'x11':
+        logger.warning('Screenshots are only supported on X11.')
+        return None
+
+    import xcffib.xproto
+    conn = qtile.core.conn
+    x, y, width, height = region or _get_screenshot_region(qtile, target) or (0, 0, 0, 0)
+    root = conn.default_screen
+    x, y = max(x, 0), max(y, 0)
+    width = min(width, root.width_in_pixels - x)
+    height = min(height, root.height_in_pixels - y)
+    if width <= 0 or height <= 0:
+        return None
+
+    cookie = conn.conn.core.GetImage(xcffib.xproto.ImageFormat.ZPixmap, root.root.wid, x, y, width, height, 0xFFFFFFFF)
+    conn.conn.flush()
+    path = os.path.join(os.path.expanduser(directory), f'{time.time():.3f}.png')
+    future = qtile.run_in_executor(_write_screenshot, conn.conn, cookie.sequence, width, height, path)
+    future.add_done_callback(_screenshot_done)
+    return future
+
+# Qubes OS preferences
+# on-disk cache of qubes-prefs values: {preference name: [value, unix timestamp of the last refresh]}
+QUBES_PREFS_CACHE = os.path.expanduser('~/.cache/qtile/qubes-prefs.json')
+
+# maximum age of cached qubes-prefs values in seconds (they are also refreshed once per qtile session)
+QUBES_PREFS_TTL = 24 * 3600
+
+_qubes_prefs = None #in-memory copy of the on-disk cache
+_qubes_prefs_refreshed = set() #preferences refreshed during this session
+
+def _load_prefs_cache():
+    try:
+        with open(QUBES_PREFS_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _store_prefs_cache():
+    try:
+        os.makedirs(os.path.dirname(QUBES_PREFS_CACHE), exist_ok=True)
+        tmp = QUBES_PREFS_CACHE + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(_qubes_prefs, f)
+        os.replace(tmp, QUBES_PREFS_CACHE)
+    except OSError:
+        logger.exception('Failed to write %s.', QUBES_PREFS_CACHE)
+
+async def _refresh_pref(name, old, callback):
+    try:
+        proc = await asyncio.create_subprocess_exec('qubes-prefs', name, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        out, _ = await proc.communicate()
+    except OSError:
+        logger.exception('Failed to execute qubes-prefs.')
+        return
+
+    #NOTE: qtile reaps all child processes on SIGCHLD, i.e. proc.returncode is unreliable
+    value = out.decode().strip()
+    if not value:
+        logger.warning('qubes-prefs %s failed.', name)
+        return
+    _qubes_prefs[name] = [value, time.time()]
+    _store_prefs_cache()
+    if callback and value != old:
+        callback(value)
+
+def get_qubes_pref(name, default=None, callback=None):
+    ''' Get a global Qubes OS preference (see `qubes-prefs`) without blocking on qubesd.
+        Values are read from an on-disk cache and refreshed in the background once per qtile session or after QUBES_PREFS_TTL.
+    :param name: Name of the preference, e.g. 'default_audiovm'.
+    :param default: Returned, if the preference was never cached before.
+    :param callback: Function to call with the new value, if a background refresh changed the returned value.
+    :return: The cached value or the default.
+    '''
+    global _qubes_prefs
+    if _qubes_prefs is None:
+        _qubes_prefs = _load_prefs_cache()
+
+    value, timestamp = _qubes_prefs.get(name, (default, 0))
+    if name not in _qubes_prefs_refreshed or time.time() - timestamp > QUBES_PREFS_TTL:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError: #no event loop, e.g. qtile check
+            return value
+        _qubes_prefs_refreshed.add(name)
+        create_task(_refresh_pref(name, value, callback))
+    return value
+
+# qubesd admin API
+QUBESD_SOCKET = '/var/run/qubesd.sock'
+
+# maximum number of concurrent qubesd calls
+QUBESD_PARALLEL = 4
+
+# time in seconds to wait before reconnecting to the qubesd events stream
+QUBESD_RECONNECT_DELAY = 5
+
+class QubesdError(Exception):
+    pass
+
+async def qubesd_call(method, dest='dom0', arg='', payload=b'', socket_path=QUBESD_SOCKET):
+    ''' Call a qubesd admin API method (dom0 only).
+    :return: The payload of the reply as bytes.
+    :raise QubesdError: if qubesd returned an error.
+    :raise OSError: on connection errors.
+    '''
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        writer.write(b'dom0\0' + f'{method}\0{dest}\0{arg}\0'.encode() + payload)
+        writer.write_eof()
+        reply = await reader.read()
+    finally:
+        writer.close()
+    if reply.startswith(b'0\0'):
+        return reply[2:]
+    raise QubesdError(f'{method} failed: ' + reply[2:].replace(b'\0', b' ').decode(errors='replace').strip())
+
+async def read_qubesd_event(reader):
+    ''' Read a single event from a qubesd admin.Events stream.
+    :return: Tuple (subject or None, event name, dict of event arguments) or None at the end of the stream.
+    :raise QubesdError: if something other than an event was received.
+    '''
+    try:
+        header = await reader.readuntil(b'\0')
+        if header != b'1\0':
+            raise QubesdError(f'Non-event received on the events connection: {header!r}')
+        subject = (await reader.readuntil(b'\0'))[:-1].decode()
+        event = (await reader.readuntil(b'\0'))[:-1].decode()
+        kwargs = {}
+        while True:
+            key = (await reader.readuntil(b'\0'))[:-1].decode()
+            if not key:
+                break
+            kwargs[key] = (await reader.readuntil(b'\0'))[:-1].decode()
+    except asyncio.IncompleteReadError:
+        return None
+    return subject or None, event, kwargs
+
+# qubesd event --> new domain state
+QUBES_EVENT_STATES = {
+    'domain-pre-start': 'Transient',
+    'domain-start': 'Running',
+    'domain-start-failed': 'Halted',
+    'domain-paused': 'Paused',
+    'domain-unpaused': 'Running',
+    'domain-pre-shutdown': 'Transient',
+    'domain-shutdown': 'Halted',
+    'domain-stopped': 'Halted',
+}
+
+# VM properties stored in the domain table
+QUBES_DOMAIN_PROPERTIES = ('label', 'memory')
+
+class QubesDomain:
+    ''' Entry of the domain table. '''
+
+    __slots__ = ('name', 'state', 'label', 'memory')
+
+    def __init__(self, name, state='Halted', label=None, memory=None):
+        self.name = name
+        self.state = state
+        self.label = label
+        self.memory = memory
+
+    def __repr__(self):
+        return f'<QubesDomain {self.name} {self.state} {self.label} {self.memory}>'
+
+class DomainTable:
+    ''' In-memory table of the Qubes OS domains, updated incrementally from qubesd events. '''
+
+    def __init__(self):
+        self.domains = {} #name --> QubesDomain
+
+    def load_list(self, payload):
+        ''' Replace the table with the domains of an admin.vm.List reply. Known properties are kept. '''
+        domains = {}
+        for line in payload.decode().splitlines():
+            name, *attrs = line.split(' ')
+            attrs = dict(attr.split('=', 1) for attr in attrs if '=' in attr)
+            domain = self.domains.get(name) or QubesDomain(name)
+            domain.state = attrs.get('state', domain.state)
+            domains[name] = domain
+        self.domains = domains
+
+    def load_properties(self, name, payload):
+        ''' Set the properties of a domain from an admin.vm.property.GetAll reply. '''
+        domain = self.domains.setdefault(name, QubesDomain(name))
+        for line in payload.decode().splitlines():
+            prop, _, rest = line.partition(' ')
+            if prop in QUBES_DOMAIN_PROPERTIES:
+                #format: default=<True|False> type=<type> <value>
+                value = rest.split(' ', 2)[2] if rest.count(' ') >= 2 else ''
+                setattr(domain, prop, value)
+
+    def apply_event(self, subject, event, kwargs):
+        ''' Update the table from a qubesd event.
+        :return: Whether the table changed, None if the domain properties must be read again.
+        '''
+        if event == 'domain-add':
+            name = kwargs.get('vm')
+            if name and name not in self.domains:
+                self.domains[name] = QubesDomain(name)
+                return None
+            return False
+        if event == 'domain-delete':
+            return self.domains.pop(kwargs.get('vm'), None) is not None
+        domain = self.domains.get(subject)
+        if domain is None:
+            return False
+
+        state = QUBES_EVENT_STATES.get(event)
+        if state:
+            if domain.state == state:
+                return False
+            domain.state = state
+            return True
+
+        kind, _, prop = event.partition(':')
+        if prop not in QUBES_DOMAIN_PROPERTIES:
+            return False
+        if kind == 'property-set':
+            value = kwargs.get('newvalue')
+            if getattr(domain, prop) == value:
+                return False
+            setattr(domain, prop, value)
+            return True
+        if kind in ('property-reset', 'property-del'):
+            return None
+        return False
+
+    def running(self):
+        ''' Get all running, paused or transient domains except dom0 sorted by name. '''
+        return [d for name, d in sorted(self.domains.items()) if d.state != 'Halted' and name != 'dom0']
+
+class QubesDomains(base._TextBox):
+    ''' Displays the running qubes with indicators in their label colors. dom0 only.
+        The widget keeps a single connection to the qubesd events stream (admin.Events) and updates its domain table from
+        the events, i.e. qubesd is not polled. The domain properties are only read once per domain.
+        For testing, socket can be set to a stand-in such as bench/fake_qubesd.py.
+    '''
+
+    defaults = [
+        ("format", "●", "Format of a single domain. Available fields: {name}, {label}, {memory}, {state}."),
+        ("separator", "", "Separator between two domains."),
+        ("colors", {}, "Label name --> colour to use instead of the colour of focused windows with that label (see QubesBorder)."),
+        ("contrast", {'black': '#CCCCCC'}, "Label name --> text background colour for labels that are hard to see on the bar. The text is drawn in the label colour (e.g. black) then."),
+        ("inactive_alpha", "50%", "Text alpha for paused and transient domains."),
+        ("socket", QUBESD_SOCKET, "Path of the qubesd socket."),
+    ]
+
+    def __init__(self, **config):
+        base._TextBox.__init__(self, '', **config)
+        self.add_defaults(QubesDomains.defaults)
+        self._label_colors = {name: QubesBorder.color_defaults[name][1] for name in QUBES_IND2LABEL.values() if name in QubesBorder.color_defaults}
+        self.table = DomainTable()
+        self._task = None
+        self._fetching = set() #domains with running admin.vm.property.GetAll calls
+        self._failures = 0 #number of consecutive connection failures
+
+    def timer_setup(self):
+        self._task = create_task(self._run())
+
+    def finalize(self):
+        if self._task:
+            self._task.cancel()
+        base._TextBox.finalize(self)
+
+    def _label_attributes(self, label):
+        ''' Get the pango span attributes to draw a domain with the given label. '''
+        background = self.contrast.get(label)
+        if background:
+            return f'foreground="{self.colors.get(label, label)}" background="{background}"'
+        return f'foreground="{self.colors.get(label) or self._label_colors.get(label) or self.foreground}"'
+
+    def render(self):
+        parts = []
+        for domain in self.table.running():
+            text = html.escape(self.format.format(name=domain.name, label=domain.label, memory=domain.memory, state=domain.state))
+            alpha = f' alpha="{self.inactive_alpha}"' if domain.state != 'Running' else ''
+            parts.append(f'<span {self._label_attributes(domain.label)}{alpha}>{text}</span>')
+        return self.separator.join(parts)
+
+    def _refresh(self):
+        self.update(self.render())
+
+    async def _fetch_properties(self, names, semaphore):
+        async def fetch(name):
+            async with semaphore:
+                try:
+                    self.table.load_properties(name, await qubesd_call('admin.vm.property.GetAll', dest=name, socket_path=self.socket))
+                except (OSError, QubesdError) as e:
+                    logger.warning('Failed to read the properties of %s: %s', name, e)
+
+        names = [name for name in names if name not in self._fetching]
+        self._fetching.update(names)
+        try:
+            await asyncio.gather(*(fetch(name) for name in names))
+        finally:
+            self._fetching.difference_update(names)
+        self._refresh()
+
+    async def _sync(self):
+        ''' Read the domain table from scratch, e.g. after (re)connecting. '''
+        self.table.load_list(await qubesd_call('admin.vm.List', socket_path=self.socket))
+        missing = [d.name for d in self.table.running() if d.label is None]
+        self._refresh()
+        create_task(self._fetch_properties(missing, asyncio.Semaphore(QUBESD_PARALLEL)))
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(QUBESD_PARALLEL)
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket)
+                try:
+                    writer.write(b'dom0\0admin.Events\0dom0\0\0')
+                    writer.write_eof()
+                    self._failures = 0
+                    while (event := await read_qubesd_event(reader)) is not None:
+                        subject, name, kwargs = event
+                        if name == 'connection-established':
+                            await self._sync()
+                            continue
+                        changed = self.table.apply_event(subject, name, kwargs)
+                        domain = self.table.domains.get(subject or kwargs.get('vm'))
+                        if domain and (changed is None or (name == 'domain-start' and domain.label is None)):
+                            create_task(self._fetch_properties([domain.name], semaphore))
+                        elif changed:
+                            self._refresh()
+                finally:
+                    writer.close()
+                logger.info('The qubesd events stream was closed.')
+            except (OSError, QubesdError) as e:
+                #NOTE: e.g. in GUI VMs without access to qubesd this fails forever
+                (logger.debug if self._failures else logger.warning)('qubesd events stream error: %s', e)
+                self._failures += 1
+            await asyncio.sleep(QUBESD_RECONNECT_DELAY)
+
+# autostart
+# maximum number of autostart entries to start at the same time
+AUTOSTART_PARALLEL = 8
+
+# time in seconds after which qtile stops waiting for an autostart script to finish (the script isn't stopped, its exit
+# code is still logged once it finishes)
+AUTOSTART_WAIT = 60
+
+# directory for the output of autostart scripts (one <entry name>.log file per entry)
+AUTOSTART_LOG_DIR = os.path.expanduser('~/.local/share/qtile/autostart')
+
+# Setting this environment variable for qtile also writes the output of autostarted applications (.desktop files) to
+# AUTOSTART_LOG_DIR. It is discarded by default as these usually run for the whole session, i.e. their logs would grow
+# without bound.
+QUBES_AUTOSTART_LOG_ENV = 'QTILE_QUBES_AUTOSTART_LOG'
+
+AUTOSTART_LOG_APPS = bool(os.environ.get(QUBES_AUTOSTART_LOG_ENV))
+
+# time in seconds after which the timing of an autostart entry is logged as warning (default qtile log level)
+AUTOSTART_SLOW = 5
+
+# desktop environment for the OnlyShowIn & NotShowIn keys of .desktop files (same as `dex-autostart -e XFCE`)
+XDG_AUTOSTART_ENVIRONMENT = 'XFCE'
+
+# field codes to remove from .desktop Exec keys (autostart entries are started without files or URLs), %% is a literal %
+_re_desktop_field_code = re.compile(r'%(.)')
+
+class AutostartEntry:
+    ''' Something to start when qtile starts, e.g. a script or an application from a .desktop file.
+        The start and end unix timestamps and the exit code are recorded once known.
+    '''
+
+    def __init__(self, name, args, wait=True):
+        '''
+        :param name: Unique name for logging.
+        :param args: Command to execute as list of arguments.
+        :param wait: Whether to wait for the command to finish (scripts) or only for it to start (applications).
+        '''
+        self.name = name
+        self.args = args
+        self.wait = wait
+        self.start = None
+        self.end = None
+        self.returncode = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    def __repr__(self):
+        return f'AutostartEntry({self.name!r}, {self.args!r}, wait={self.wait!r})'
+
+def script_entry(path, name):
+    ''' Create an AutostartEntry for a script.
+    :return: AutostartEntry or None, if the script doesn't exist.
+    '''
+    path = os.path.expanduser(path)
+    if not os.path.isfile(path):
+        return None
+    return AutostartEntry(name, [path])
+
+def parse_desktop_file(path):
+    ''' Parse the [Desktop Entry] group of a .desktop file.
+    :return: dict of keys to values or None, if the file couldn't be read.
+    '''
+    ret = {}
+    group = None
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('['):
+                    group = line
+                elif group == '[Desktop Entry]' and '=' in line:
+                    key, value = line.split('=', 1)
+                    ret[key.strip()] = value.strip()
+    except (OSError, UnicodeDecodeError):
+        logger.exception('Failed to read %s.', path)
+        return None
+    return ret
+
+def desktop_entry(path):
+    ''' Create an AutostartEntry for an XDG .desktop file according to the XDG autostart specification.
+    :return: AutostartEntry or None, if the file shouldn't be started.
+    '''
+    desktop = parse_desktop_file(path)
+    if not desktop or desktop.get('Hidden') == 'true' or not desktop.get('Exec'):
+        return None
+    if desktop.get('Type', 'Application') != 'Application':
+        return None
+    if 'OnlyShowIn' in desktop and XDG_AUTOSTART_ENVIRONMENT not in desktop['OnlyShowIn'].split(';'):
+        return None
+    if XDG_AUTOSTART_ENVIRONMENT in desktop.get('NotShowIn', '').split(';'):
+        return None
+    if desktop.get('TryExec') and not shutil.which(desktop['TryExec']):
+        return None
+
+    try:
+        args = shlex.split(_re_desktop_field_code.sub(lambda m: '%' if m.group(1) == '%' else '', desktop['Exec']))
+    except ValueError:
+        logger.warning('autostart: Invalid Exec key in %s.', path)
+        return None
+    if not args:
+        return None
+    return AutostartEntry(os.path.basename(path), args, wait=False)
+
+def _log_path(entry):
+    return os.path.join(AUTOSTART_LOG_DIR, entry.name + '.log')
+
+def _timing_logger(duration):
+    ''' Get the log function for the timing of an autostart entry. Slow entries are logged as warnings, others only with
+        startup profiling enabled or at a lower log level.
+    '''
+    return logger.warning if STARTUP_PROFILE or duration >= AUTOSTART_SLOW else logger.info
+
+def _finish_entry(entry, out):
+    entry.end = time.time()
+    out = out.decode().strip()
+    entry.returncode = int(out) if out.isdigit() else None
+    if entry.returncode == 0:
+        _timing_logger(entry.duration)('autostart: %s finished after %.3fs.', entry.name, entry.duration)
+    else:
+        logger.warning('autostart: %s failed after %.3fs with exit code %s. See %s.', entry.name, entry.duration, entry.returncode, _log_path(entry))
+
+async def _finish_late(entry, proc):
+    #NOTE: only waits for the pipe of the shell, i.e. never finishes for scripts running for the whole session
+    _finish_entry(entry, await proc.stdout.read())
+
+def _open_log(entry):
+    if AUTOSTART_LOG_APPS:
+        return open(_log_path(entry), 'wb')
+    return open(os.devnull, 'wb')
+
+async def _run_entry(entry, semaphore, wait):
+    async with semaphore:
+        entry.start = time.time()
+        try:
+            if entry.wait:
+                #NOTE: qtile reaps all child processes on SIGCHLD, i.e. the asyncio exit codes are unreliable. We therefore
+                #      let a shell report the exit code. The pipe is only kept open by that shell, not by programs started from
+                #      the script.
+                proc = await asyncio.create_subprocess_exec('/bin/sh', '-c', '"$@" > "$0" 2>&1 < /dev/null; echo $?', _log_path(entry), *entry.args,
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, start_new_session=True)
+            else:
+                with _open_log(entry) as log:
+                    proc = await asyncio.create_subprocess_exec(*entry.args,
+                        stdin=asyncio.subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+        except OSError as e:
+            entry.end = time.time()
+            logger.warning('autostart: Failed to start %s: %s', entry.name, e)
+            return
+
+        if not entry.wait:
+            entry.end = time.time()
+            _timing_logger(entry.duration)('autostart: Started %s with PID %d after %.3fs.', entry.name, proc.pid, entry.duration)
+            return
+
+        try:
+            out = await asyncio.wait_for(proc.stdout.read(), wait)
+        except asyncio.TimeoutError:
+            logger.warning('autostart: %s is still running after %gs. Continuing in the background.', entry.name, wait)
+            create_task(_finish_late(entry, proc))
+            return
+        _finish_entry(entry, out)
+
+async def run_autostart(entries, parallel=None, wait=None):
+    ''' Run autostart entries concurrently.
+        The output of scripts is written to AUTOSTART_LOG_DIR (the output of applications only with AUTOSTART_LOG_APPS),
+        timing information and failures are logged to the qtile log.
+    :param entries: Iterable of AutostartEntry objects. None entries are ignored.
+    :param parallel: Maximum number of entries to start at the same time (default: AUTOSTART_PARALLEL).
+    :param wait: Time in seconds after which to stop waiting for each script (default: AUTOSTART_WAIT). Slower scripts
+        continue to run in the background.
+    :return: List of the AutostartEntry objects that were run.
+    '''
+    entries = [e for e in entries if e]
+    semaphore = asyncio.Semaphore(parallel or AUTOSTART_PARALLEL)
+    wait = wait or AUTOSTART_WAIT
+    try:
+        os.makedirs(AUTOSTART_LOG_DIR, exist_ok=True)
+    except OSError:
+        logger.exception('Failed to create %s.', AUTOSTART_LOG_DIR)
+
+    start = time.time()
+    await asyncio.gather(*[_run_entry(e, semaphore, wait) for e in entries])
+    #NOTE: the default qtile log level only shows warnings & errors
+    logger.warning('autostart: Processed %d entries in %.3fs.', len(entries), time.time() - start)
+    return entries
+
+def xdg_autostart_dirs():
+    ''' Get the XDG autostart directories in the order of decreasing precedence. '''
+    config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    config_dirs = os.environ.get('XDG_CONFIG_DIRS') or '/etc/xdg'
+    return [os.path.join(d, 'autostart') for d in [config_home, *config_dirs.split(':')] if d]
+
+def xdg_autostart_entries():
+    ''' Get the AutostartEntry objects for the .desktop files in the XDG autostart directories.
+        Files in directories with a higher precedence hide files with the same name in other directories.
+    '''
+    files = {}
+    for d in reversed(xdg_autostart_dirs()):
+        try:
+            for f in os.listdir(d):
+                if f.endswith('.desktop'):
+                    files[f] = os.path.join(d, f)
+        except OSError:
+            pass
+    return [desktop_entry(files[f]) for f in sorted(files)]
+
+def _command_key(args):
+    return (os.path.basename(args[0]), *args[1:])
+
+def _running_commands():
+    ''' Read the process table.
+    :return: Set of command keys of all running processes. Commands run by an interpreter (e.g. python3) are included without it.
+    '''
+    ret = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                args = f.read().decode(errors='replace').split('\0')[:-1]
+        except OSError: #process exited
+            continue
+        for i in range(min(len(args), 2)):
+            ret.add(_command_key(args[i:]))
+    return ret
+
+def remove_running(entries):
+    ''' Remove the autostart entries with a running process and None entries from the given list.
+        The process table is read only once.
+    :return: The entries that are not running.
+    '''
+    running = _running_commands()
+    ret = []
+    for e in entries:
+        if not e:
+            continue
+        if _command_key(e.args) in running:
+            logger.info('autostart: %s is already running.', e.name)
+        else:
+            ret.append(e)
+    return ret
+
+def _skip_xdg_autostart():
+    ''' Whether the XDG autostart should be skipped on this boot. '''
+    try:
+        with open('/proc/cmdline') as f:
+            if 'qubes.skip_autostart' in f.read():
+                logger.warning('autostart: Found qubes.skip_autostart in the kernel commandline. Not starting any .desktop files.')
+                return True
+    except OSError:
+        pass
+
+    #the user handles it
+    try:
+        with open(os.path.expanduser('~/.config/qtile/autostart_once.sh')) as f:
+            return 'dex-autostart' in f.read()
+    except OSError:
+        return False
 
-# autostart hooks
 @hook.subscribe.startup_once
 async def qubes_autostart_once():
-    system_autostart = asyncio.create_subprocess_shell('/etc/xdg/qtile/autostart_once.sh |& logger -t autostart_once.sh_system')
-    user_autostart = asyncio.create_subprocess_shell('~/.config/qtile/autostart_once.sh |& logger -t autostart_once.sh_user')
-    await asyncio.gather(user_autostart, system_autostart)
+    entries = [
+        script_entry('/etc/xdg/qtile/autostart_once.sh', 'autostart_once.sh_system'),
+        script_entry('~/.config/qtile/autostart_once.sh', 'autostart_once.sh_user'),
+    ]
+    if not _skip_xdg_autostart():
+        #NOTE: qtile may have been restarted without a reboot
+        entries.extend(remove_running(xdg_autostart_entries()))
+    await run_autostart(entries)
 
 @hook.subscribe.startup
 async def qubes_autostart():
-    system_autostart = asyncio.create_subprocess_shell('/etc/xdg/qtile/autostart.sh |& logger -t autostart.sh_system')
-    user_autostart = asyncio.create_subprocess_shell('~/.config/qtile/autostart.sh |& logger -t autostart.sh_user')
-    await asyncio.gather(user_autostart, system_autostart)
+    await run_autostart([
+        script_entry('/etc/xdg/qtile/autostart.sh', 'autostart.sh_system'),
+        script_entry('~/.config/qtile/autostart.sh', 'autostart.sh_user'),
+    ])
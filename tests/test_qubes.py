@@ -0,0 +1,85 @@
+# vim: fileencoding=utf-8
+#
+# Copyright (C) 2024
+#                   David Hobach <tripleh@hackingthe.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+''' Unit tests of qubes.py.
+
+    Usage: qtile-env/bin/python -m pytest tests/
+
+    They must be run with a python that has qtile & pytest installed, e.g. the one of the venv created by the installer.
+'''
+
+import datetime
+import importlib.util
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('libqtile')
+pytest.importorskip('qtile_extras')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_qubes():
+    spec = importlib.util.spec_from_file_location('libqtile.qubes', os.path.join(REPO_DIR, 'qubes.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['libqtile.qubes'] = module
+    spec.loader.exec_module(module)
+    return module
+
+qubes = load_qubes()
+
+TODAY = datetime.date(2026, 10, 18)
+
+@pytest.mark.parametrize('line, expected', [
+    ('', (2026, 10, 1, (2026, 10, 18))),
+    ('-3', (2026, 9, 3, (2026, 10, 18))),
+    ('-n 4', (2026, 10, 4, (2026, 10, 18))),
+    ('-n4', (2026, 10, 4, (2026, 10, 18))),
+    ('--months 3', (2026, 10, 3, (2026, 10, 18))),
+    ('--months=5', (2026, 10, 5, (2026, 10, 18))),
+    ('-y', (2026, 1, 12, (2026, 10, 18))),
+    ('2 2027', (2027, 2, 1, (2026, 10, 18))),
+])
+def test_parse_cal_args(line, expected):
+    assert qubes.parse_cal_args(line, TODAY) == expected
+
+@pytest.mark.parametrize('line', ['--months', '--months x', '-n 0', '--foo', '1 2 3 4'])
+def test_parse_cal_args_invalid(line):
+    with pytest.raises(ValueError):
+        qubes.parse_cal_args(line, TODAY)
+
+@pytest.mark.parametrize('volume, steps, limit, expected', [
+    (90, 5, True, 100),
+    (90, 5, False, 105),
+    (110, 1, True, 110),
+    (10, -5, True, 0),
+])
+def test_volume_clamp(monkeypatch, volume, steps, limit, expected):
+    widget = qubes.QubesVolume(audiovm='vm', step=3, limit_max_volume=limit)
+    monkeypatch.setattr(widget, 'timeout_add', lambda delay, func: None)
+    monkeypatch.setattr(widget, '_update_drawer', lambda: None)
+    monkeypatch.setattr(widget, 'bar', type('Bar', (), {'draw': lambda self: None})(), raising=False)
+    widget.volume = volume
+    change = widget.increase_vol if steps > 0 else widget.decrease_vol
+    for _ in range(abs(steps)):
+        change()
+    assert widget.volume == expected
+    assert widget._pending == expected - volume